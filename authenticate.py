@@ -3,51 +3,63 @@ from flask import Flask, request, Response
 from splitwise_manager import SplitWiseManager
 
 
-app = Flask(__name__)
-sw = SplitWiseManager()
+def create_app(sw):
+    """
+    :param sw: the SplitWiseManager that launched the authentication, the
+    callback checks its authentication_state.
+    """
+    app = Flask(__name__)
 
+    @app.route('/generate_token/')
+    def index():
+        code = request.args.get('code')
+        state = request.args.get('state')
 
-@app.route('/generate_token/')
-def index():
-    code = request.args.get('code')
-    state = request.args.get('state')
+        # Callback parameters check
+        if not code or not state:
+            msg = ("Either or both parameters 'code' and 'state' not found in "
+                   "get. This endpoint is meant for the Splitwise's auth "
+                   "process to call back the app. Are you accessing it "
+                   "directly?")
+            return Response(msg, mimetype='text/plain')
+        if state != sw.authentication_state:
+            msg = ("Supplied 'state' parameter doesn't match the one "
+                   "generated during authentication initialization. Make sure "
+                   "that you are using the right tab. If you launched the "
+                   "authentication multiple times, close all tabs, stop the "
+                   "script, and launch it again.")
+            return Response(msg, mimetype='text/plain')
 
-    # Callback parameters check
-    if not code or not state:
-        msg = ("Either or both parameters 'code' and 'state' not found in get."
-               " This endpoint is meant for the Splitwise's auth process to "
-               "call back the app. Are you accessing it directly?")
-        return Response(msg, mimetype='text/plain')
-    if state != sw.authentication_state:
-        msg = ("Supplied 'state' parameter doesn't match the one generated "
-               "during authentication initialization. Make sure that you are "
-               "using the right tab. If you launched the authentication "
-               "multiple times, close all tabs, stop the script, and launch it"
-               " again.")
-        return Response(msg, mimetype='text/plain')
+        access_token = sw.get_access_token(code)
+        if not access_token:
+            msg = ("Failed to generate token with the supplied code "
+                   "parameter. Try to launch the authentication script again.")
+            return Response(msg, mimetype='text/plain')
+        print("Token generation finished. Copy the token code inside your "
+              ".env file:")
+        print(access_token)
+        msg = (f"Token generation finished. You can close this tab and go "
+               f"back to the console for more instructions.")
 
-    access_token = sw.get_access_token(code)
-    if not access_token:
-        msg = ("Failed to generate token with the supplied code parameter. Try"
-               " to launch the authentication script again.")
+        # Stopping the server:
+        shutdown_hook = request.environ.get('werkzeug.server.shutdown')
+        if shutdown_hook is not None:
+            shutdown_hook()
         return Response(msg, mimetype='text/plain')
-    print("Token generation finished. Copy the token code inside your .env "
-          "file:")
-    print(access_token)
-    msg = (f"Token generation finished. You can close this tab and go back to "
-           f"the console for more instructions.")
 
-    # Stopping the server:
-    shutdown_hook = request.environ.get('werkzeug.server.shutdown')
-    if shutdown_hook is not None:
-        shutdown_hook()
-    return Response(msg, mimetype='text/plain')
+    return app
 
 
-if __name__ == '__main__':
+def main():
+    sw = SplitWiseManager()
+    app = create_app(sw)
     print("Launching Splitwise authentication in a browser. Please follow "
           "the steps and come back when finished.")
     sw.launch_authentication()
     # Beware that with debug=True it runs 2 times (2 browser tabs will be
     # open)
     app.run(port=1337, debug=False)
+
+
+if __name__ == '__main__':
+    main()
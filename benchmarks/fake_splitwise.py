@@ -0,0 +1,243 @@
+"""
+Local stand-in for splitwise.Splitwise, to synchronize without the network.
+
+FakeSplitwise answers getCurrentUser, getExpenses, getComments and
+getCategories from fixtures, which can be generated (see fixtures_for) or
+recorded from the real API with RecordingSplitwise. Every request can be
+delayed (latency +/- jitter) and randomly answered with a 429, to test the
+fetching concurrency and backoff.
+
+Fixtures format (JSON):
+
+    {
+        "current_user": {"id": 1},
+        "expenses": [ExpenseMirror payloads],
+        "comments": {"<expense id>": [{"user_id": 1, "content": "cash"}]},
+        "categories": [{"id": 1, "name": "Utilities",
+                        "subcategories": [{"id": 5, "name": "Electricity"}]}]
+    }
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from splitwise.exception import SplitwiseException
+
+from local_store import MirroredExpense, MirroredUser
+from benchmarks.generate_expenses import CATEGORIES, CURRENT_USER_ID
+
+SPLITWISE_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class FakeResponse:
+    """
+    The bits of a requests.Response that SplitwiseException looks at.
+    """
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.content = b''
+        self.headers = headers or {}
+
+
+class FakeComment:
+    def __init__(self, data):
+        self.data = data
+
+    def getCommentedUser(self):
+        return MirroredUser({'id': self.data['user_id']})
+
+    def getContent(self):
+        return self.data['content']
+
+
+class FakeCategory:
+    def __init__(self, data):
+        self.data = data
+        self.subcategories = [
+            FakeCategory(subcategory)
+            for subcategory in data.get('subcategories', [])
+        ]
+
+    def getId(self):
+        return self.data['id']
+
+    def getName(self):
+        return self.data['name']
+
+
+def fixtures_for(payloads):
+    """
+    :param payloads: ExpenseMirror payloads, like generate_expenses' ones.
+    :return: fixtures where the expenses with cash_comment have a cash
+    comment by the current user.
+    """
+    expenses = []
+    comments = {}
+    for payload in payloads:
+        if payload.get('cash_comment'):
+            comments[str(payload['id'])] = [
+                {'user_id': CURRENT_USER_ID, 'content': 'cash'}
+            ]
+        expenses.append(dict(payload, cash_comment=None))
+    return {
+        'current_user': {'id': CURRENT_USER_ID},
+        'expenses': expenses,
+        'comments': comments,
+        'categories': [
+            {'id': category_id, 'name': str(bucket), 'subcategories': []}
+            for category_id, bucket in CATEGORIES.items()
+        ],
+    }
+
+
+class FakeSplitwise:
+    def __init__(self, fixtures, latency=0.0, jitter=0.0,
+                 rate_limited=0.0, retry_after=1, seed=0):
+        """
+        :param latency: seconds that every request takes.
+        :param jitter: up to this many seconds more or less.
+        :param rate_limited: ratio (0 to 1) of requests answered with a 429.
+        :param retry_after: Retry-After header of the 429 responses, None to
+        leave it out.
+        """
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Requests by method, and how many of them got a 429.
+        self.requests = Counter()
+        self.rejected = Counter()
+        # Newest first, like the API.
+        self.expenses = sorted(
+            fixtures['expenses'],
+            key=lambda payload: (payload['date'], payload['id']),
+            reverse=True
+        )
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path) as fixtures_file:
+            return cls(json.load(fixtures_file), **kwargs)
+
+    def request(self, method):
+        with self.lock:
+            self.requests[method] += 1
+            delay = self.latency + self.random.uniform(
+                -self.jitter, self.jitter
+            )
+            rejected = self.random.random() < self.rate_limited
+            if rejected:
+                self.rejected[method] += 1
+        time.sleep(max(delay, 0))
+        if rejected:
+            headers = {}
+            if self.retry_after is not None:
+                headers['Retry-After'] = str(self.retry_after)
+            # Raised like the real client raises it for a 429.
+            raise SplitwiseException(
+                "Unknown error happened", FakeResponse(429, headers)
+            )
+
+    def setOAuth2AccessToken(self, access_token):
+        pass
+
+    def getCurrentUser(self):
+        self.request('getCurrentUser')
+        return MirroredUser(self.fixtures['current_user'])
+
+    def getExpenses(self, offset=None, limit=None, dated_after=None,
+                    updated_after=None, **kwargs):
+        self.request('getExpenses')
+        if isinstance(dated_after, datetime):
+            dated_after = dated_after.strftime(SPLITWISE_DATE_FORMAT)
+        if isinstance(updated_after, datetime):
+            updated_after = updated_after.strftime(SPLITWISE_DATE_FORMAT)
+        expenses = [
+            payload for payload in self.expenses
+            if (not dated_after or payload['date'] > dated_after)
+            and (not updated_after or payload['updated_at'] > updated_after)
+        ]
+        offset = offset or 0
+        if limit:
+            expenses = expenses[offset:offset + limit]
+        else:
+            expenses = expenses[offset:]
+        return [MirroredExpense(payload) for payload in expenses]
+
+    def getComments(self, expense_id):
+        self.request('getComments')
+        return [
+            FakeComment(comment)
+            for comment in self.fixtures['comments'].get(str(expense_id), [])
+        ]
+
+    def getCategories(self):
+        self.request('getCategories')
+        return [FakeCategory(category)
+                for category in self.fixtures['categories']]
+
+
+class RecordingSplitwise:
+    """
+    Wraps a real splitwise.Splitwise and keeps what it answers as fixtures
+    for FakeSplitwise.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+        self.fixtures = {
+            'current_user': None,
+            'expenses': [],
+            'comments': {},
+            'categories': [],
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+    def getCurrentUser(self):
+        user = self.instance.getCurrentUser()
+        self.fixtures['current_user'] = {'id': user.getId()}
+        return user
+
+    def getExpenses(self, *args, **kwargs):
+        expenses = self.instance.getExpenses(*args, **kwargs)
+        self.fixtures['expenses'].extend(
+            MirroredExpense.payload(expense) for expense in expenses
+        )
+        return expenses
+
+    def getComments(self, expense_id):
+        comments = self.instance.getComments(expense_id)
+        self.fixtures['comments'][str(expense_id)] = [
+            {
+                'user_id': comment.getCommentedUser().getId(),
+                'content': comment.getContent(),
+            }
+            for comment in comments
+        ]
+        return comments
+
+    def getCategories(self):
+        categories = self.instance.getCategories()
+        self.fixtures['categories'] = [
+            {
+                'id': category.getId(),
+                'name': category.getName(),
+                'subcategories': [
+                    {'id': sub.getId(), 'name': sub.getName()}
+                    for sub in category.subcategories
+                ],
+            }
+            for category in categories
+        ]
+        return categories
+
+    def save(self, path):
+        with open(path, 'w') as fixtures_file:
+            json.dump(self.fixtures, fixtures_file, indent=2)
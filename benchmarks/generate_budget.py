@@ -0,0 +1,116 @@
+"""
+Synthetic Buckets budget files, with the tables and columns described in
+https://docs.budgetwithbuckets.com/fileformat/ that the synchronization uses.
+"""
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+ACCOUNTS = {
+    'splitwise': 'Splitwise',
+    'payment': 'Main bank account',
+    'cash': 'Cash',
+}
+BUCKETS = ['Food', 'Fun', 'Home', 'Transport']
+
+SCHEMA = """
+CREATE TABLE account (
+    id INTEGER PRIMARY KEY,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    name TEXT DEFAULT '',
+    balance INTEGER DEFAULT 0,
+    currency TEXT,
+    import_balance INTEGER DEFAULT NULL,
+    closed TINYINT DEFAULT 0,
+    notes TEXT DEFAULT '',
+    offbudget TINYINT DEFAULT 0,
+    kind TEXT DEFAULT ''
+);
+CREATE TABLE bucket (
+    id INTEGER PRIMARY KEY,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    name TEXT DEFAULT '',
+    notes TEXT DEFAULT '',
+    balance INTEGER DEFAULT 0,
+    kicked TINYINT DEFAULT 0
+);
+CREATE TABLE account_transaction (
+    id INTEGER PRIMARY KEY,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    posted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    account_id INTEGER,
+    amount INTEGER,
+    memo TEXT,
+    fi_id TEXT,
+    general_cat TEXT DEFAULT '',
+    notes TEXT DEFAULT '',
+    cleared TINYINT DEFAULT 0,
+    FOREIGN KEY(account_id) REFERENCES account(id)
+);
+CREATE TABLE bucket_transaction (
+    id INTEGER PRIMARY KEY,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    posted TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    bucket_id INTEGER,
+    amount INTEGER,
+    memo TEXT,
+    account_trans_id INTEGER,
+    transfer TINYINT DEFAULT 0
+);
+"""
+
+
+def create_budget(path, transactions, synced_expenses=0, seed=0):
+    """
+    :param transactions: number of account_transaction rows in the file.
+    :param synced_expenses: how many of them are Splitwise expenses 1 to
+    synced_expenses already synchronized, the rest are bank imports.
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    connection.executemany(
+        "INSERT INTO account (name) VALUES (?)",
+        [(name, ) for name in ACCOUNTS.values()]
+    )
+    connection.executemany(
+        "INSERT INTO bucket (name) VALUES (?)",
+        [(name, ) for name in BUCKETS]
+    )
+    # Ids as inserted above.
+    splitwise_id, payment_id, cash_id = 1, 2, 3
+    start = datetime.now() - timedelta(days=365)
+
+    def rows():
+        for i in range(transactions):
+            posted = (start + timedelta(minutes=i)).isoformat(" ")
+            amount = -rng.randint(100, 10000)
+            if i < synced_expenses:
+                yield (i + 1, posted, splitwise_id, amount,
+                       f"expense {i + 1}", str(i + 1), None)
+            else:
+                account_id = payment_id if i % 5 else cash_id
+                yield (i + 1, posted, account_id, amount, f"bank {i}",
+                       f"bank-{i}", '')
+
+    connection.executemany(
+        """
+        INSERT INTO account_transaction (
+            id, posted, account_id, amount, memo, fi_id, general_cat
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows()
+    )
+    connection.execute(
+        """
+        INSERT INTO bucket_transaction (
+            posted, bucket_id, amount, memo, account_trans_id
+        )
+        SELECT posted, 1 + id % ?, amount, memo, id
+        FROM account_transaction WHERE id % 2 = 0
+        """,
+        (len(BUCKETS), )
+    )
+    connection.commit()
+    connection.close()
@@ -0,0 +1,106 @@
+"""
+Synthetic Splitwise expenses, as the payloads saved by ExpenseMirror, covering
+every branch of SplitwiseToBucketsSynch.handle_expense.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+CURRENT_USER_ID = 1
+OTHER_USER_ID = 2
+CASH_KEYWORD = 'cash'
+# Splitwise category ids, mapped to the synthetic budget buckets.
+CATEGORIES = {13: 'Food', 20: 'Fun', 16: 'Home', 36: 'Transport', 18: None}
+
+KINDS = [
+    'payment',
+    'paid_nothing',
+    'paid_less',
+    'paid_same',
+    'paid_more',
+    'paid_for_others',
+    'cash_details',
+    'cash_comment',
+    'deleted',
+    'debt_consolidation',
+]
+
+
+def amount(cents):
+    return f"{cents // 100}.{cents % 100:02d}"
+
+
+def user(user_id, paid, owed):
+    return {'id': user_id, 'paid_share': amount(paid),
+            'owed_share': amount(owed)}
+
+
+def generate_expenses(count, seed=0):
+    """
+    :return: generator of ExpenseMirror payloads, ids 1 to count, going
+    through KINDS in order.
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    for i in range(count):
+        kind = KINDS[i % len(KINDS)]
+        cost = rng.randint(100, 20000)
+        mine = cost // 2
+        others = cost - mine
+        date = (now - timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        payload = {
+            'id': i + 1,
+            'description': f"{kind} {i + 1}",
+            'date': date,
+            'cost': amount(cost),
+            'payment': False,
+            'creation_method': None,
+            'details': None,
+            'comments_count': 0,
+            'updated_at': date,
+            'deleted_at': None,
+            'category': {
+                'id': rng.choice(list(CATEGORIES)), 'name': 'Category'
+            },
+            'users': [
+                user(CURRENT_USER_ID, cost, mine),
+                user(OTHER_USER_ID, 0, others),
+            ],
+            'cash_comment': None,
+        }
+        if kind == 'payment':
+            payload['payment'] = True
+            payload['users'] = [
+                user(CURRENT_USER_ID, 0, cost),
+                user(OTHER_USER_ID, cost, 0),
+            ]
+        elif kind == 'paid_nothing':
+            payload['users'] = [
+                user(CURRENT_USER_ID, 0, mine),
+                user(OTHER_USER_ID, cost, others),
+            ]
+        elif kind == 'paid_less':
+            paid = rng.randint(1, mine - 1) if mine > 1 else 0
+            payload['users'] = [
+                user(CURRENT_USER_ID, paid, mine),
+                user(OTHER_USER_ID, cost - paid, others),
+            ]
+        elif kind == 'paid_same':
+            payload['users'] = [
+                user(CURRENT_USER_ID, mine, mine),
+                user(OTHER_USER_ID, others, others),
+            ]
+        elif kind == 'paid_for_others':
+            payload['users'] = [
+                user(CURRENT_USER_ID, cost, 0),
+                user(OTHER_USER_ID, 0, cost),
+            ]
+        elif kind == 'cash_details':
+            payload['details'] = CASH_KEYWORD
+        elif kind == 'cash_comment':
+            payload['comments_count'] = 1
+            payload['cash_comment'] = True
+        elif kind == 'deleted':
+            payload['deleted_at'] = date
+        elif kind == 'debt_consolidation':
+            payload['creation_method'] = 'debt_consolidation'
+        yield payload
@@ -0,0 +1,100 @@
+"""
+Startup time benchmark.
+
+For every command it starts a fresh Python process, --repeat times, and
+measures with -X importtime how long its imports take, keeping the fastest
+run, and which of the heavy dependencies (HEAVY_MODULES) it ended up
+importing. Nothing is synchronized: the commands only import modules or
+print their help.
+
+With --max-ms it fails if any of them takes longer, to catch a heavy import
+creeping back into a module that cron runs load.
+
+Run it from the repository's folder:
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --max-ms 150
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, arguments of python)
+COMMANDS = [
+    ('cli.py --help', ['cli.py', '--help']),
+    ('cli.py sync --help', ['cli.py', 'sync', '--help']),
+    ('import synch', ['-c', 'import synch']),
+    ('import splitwise_manager', ['-c', 'import splitwise_manager']),
+    ('import buckets_manager', ['-c', 'import buckets_manager']),
+    ('import profiles', ['-c', 'import profiles']),
+]
+
+HEAVY_MODULES = (
+    'flask', 'splitwise', 'requests', 'tabulate', 'tqdm', 'yaspin',
+)
+
+# import time: self [us] | cumulative | imported package
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+\d+ \| +(\S+)')
+
+
+def measure(arguments):
+    """
+    :return: (milliseconds importing modules, heavy modules imported)
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + arguments,
+        cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True
+    )
+    total_us = 0
+    heavy = set()
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match is None:
+            continue
+        self_us, module = match.groups()
+        total_us += int(self_us)
+        if module.split('.')[0] in HEAVY_MODULES:
+            heavy.add(module.split('.')[0])
+    return total_us / 1000, heavy
+
+
+def main(argv=None, prog=None):
+    from tabulate import tabulate
+
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Measure how long the commands take to import what "
+                    "they need."
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--max-ms', type=float,
+        help="Fail if any command spends more than this importing."
+    )
+    args = parser.parse_args(argv)
+
+    rows = []
+    for name, arguments in COMMANDS:
+        runs = [measure(arguments) for _ in range(args.repeat)]
+        milliseconds = min(ms for ms, heavy in runs)
+        heavy = runs[0][1]
+        rows.append((name, milliseconds, ', '.join(sorted(heavy)) or '-'))
+    print(tabulate(
+        rows, ['command', 'import ms', 'heavy modules'],
+        tablefmt="fancy_grid", floatfmt=".1f"
+    ))
+    if args.max_ms is not None:
+        slow = [name for name, milliseconds, heavy in rows
+                if milliseconds > args.max_ms]
+        if slow:
+            print(f"Slower than {args.max_ms} ms: {', '.join(slow)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+End-to-end synchronization benchmark.
+
+For every combination of --expenses and --transactions it creates, in a
+temporary folder, a synthetic budget file and a local store with the synthetic
+expenses mirrored, and runs the whole synchronization offline in a fresh
+process, measuring:
+
+- expenses synchronized per second,
+- SQL statements run on the budget file, in total and per expense,
+- peak memory (max RSS) of the process,
+- expenses that failed to synchronize, which should always be 0.
+
+With --statements-per-expense, every expense that makes handle_expense run
+more SQL statements than that fails with QueryBudgetExceeded, so an N+1
+regression in buckets_manager.py shows up in the errors column.
+
+With --api it runs online instead, against benchmarks.fake_splitwise with the
+given latency, jitter and ratio of 429 responses, and also reports the
+requests made to it.
+
+Run it from the repository's folder:
+
+    python -m benchmarks.run --expenses 1000 10000 --transactions 100000
+    python -m benchmarks.run --expenses 1000 --api --latency 0.05
+"""
+import argparse
+import itertools
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import get_context
+
+import yaml
+
+from benchmarks.generate_budget import ACCOUNTS, create_budget
+from benchmarks.generate_expenses import (
+    CASH_KEYWORD, CATEGORIES, CURRENT_USER_ID, generate_expenses
+)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure(workdir, budget_path, settings):
+    """
+    Sets up the configuration from config.template.yaml, pointing to the
+    synthetic files, plus any --setting given.
+    """
+    from settings import config
+    config.set_file(os.path.join(REPO_DIR, 'config.template.yaml'))
+    config.set({
+        'LocalStorePath': os.path.join(workdir, 'local_store.sqlite'),
+        'Buckets': {
+            'BudgetFilePath': budget_path,
+            'AccountsKeywords': ACCOUNTS,
+        },
+        'Splitwise': {
+            'StateFilePath': os.path.join(workdir, 'sync_state.json'),
+            'ExpensesDaysAgo': 36500,
+            'ExpensesDatedAfter': '1970-01-01',
+            'ExpensesCashKeyword': CASH_KEYWORD,
+        },
+        'SplitwiseCategoriesToBucketNames': CATEGORIES,
+    })
+    for key, value in settings:
+        view = config
+        for part in key.split('.'):
+            view = view[part]
+        view.set(value)
+
+
+def measure(expenses, transactions, settings, seed, api=None,
+            statements_per_expense=None):
+    """
+    :param api: None to synchronize offline, or the keyword arguments of
+    FakeSplitwise to synchronize online against it.
+    :param statements_per_expense: budget of SQL statements of each
+    handle_expense, None for no budget.
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        budget_path = os.path.join(workdir, 'budget.buckets')
+        # Half of the expenses are already in the budget, to go through the
+        # updates as well.
+        create_budget(
+            budget_path, transactions,
+            synced_expenses=min(transactions, expenses // 2), seed=seed
+        )
+        configure(workdir, budget_path, settings)
+
+        payloads = generate_expenses(expenses, seed=seed)
+        fake_splitwise = None
+        if api is None:
+            import local_store
+            mirror = local_store.ExpenseMirror(
+                local_store.connect(), CURRENT_USER_ID
+            )
+            while True:
+                chunk = list(itertools.islice(payloads, 1000))
+                if not chunk:
+                    break
+                mirror.save_many(chunk)
+        else:
+            from benchmarks.fake_splitwise import FakeSplitwise, fixtures_for
+            fake_splitwise = FakeSplitwise(
+                fixtures_for(payloads), seed=seed, **api
+            )
+
+        from sql_profiler import SqlProfiler
+        from synch import SplitwiseToBucketsSynch
+
+        class BudgetedSynch(SplitwiseToBucketsSynch):
+            def handle_expense(self, exp_obj, operations=None):
+                with self.bk.profiler.budget(
+                        statements_per_expense, 'handle_expense'):
+                    super().handle_expense(exp_obj, operations)
+
+        synch_class = SplitwiseToBucketsSynch
+        if statements_per_expense is not None:
+            synch_class = BudgetedSynch
+        statements = 0
+
+        def count_statement(statement):
+            nonlocal statements
+            statements += 1
+
+        with open(os.devnull, 'w') as devnull, \
+                redirect_stdout(devnull), redirect_stderr(devnull):
+            start = time.perf_counter()
+            synch = synch_class(
+                offline=api is None, splitwise=fake_splitwise
+            )
+            synch.bk.connection.set_trace_callback(count_statement)
+            if statements_per_expense is not None:
+                synch.bk.profiler = SqlProfiler()
+            synch.run()
+            elapsed = time.perf_counter() - start
+
+    # In KB on Linux.
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = {
+        'expenses': expenses,
+        'transactions': transactions,
+        'seconds': elapsed,
+        'expenses/s': expenses / elapsed,
+        'statements': statements,
+        'statements/expense': statements / expenses,
+        'peak MB': peak_memory / 1024,
+        'errors': synch.errors,
+    }
+    if fake_splitwise is not None:
+        result['requests'] = sum(fake_splitwise.requests.values())
+        result['429s'] = sum(fake_splitwise.rejected.values())
+    return result
+
+
+def parse_setting(setting):
+    key, value = setting.split('=', 1)
+    return key, yaml.safe_load(value)
+
+
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Benchmark the synchronization with synthetic data."
+    )
+    parser.add_argument(
+        '--expenses', type=int, nargs='+', default=[1000, 10000, 100000],
+        help="Numbers of Splitwise expenses to synchronize."
+    )
+    parser.add_argument(
+        '--transactions', type=int, nargs='+', default=[10000],
+        help="Numbers of transactions already in the budget file."
+    )
+    parser.add_argument(
+        '--setting', type=parse_setting, action='append', default=[],
+        metavar='KEY=VALUE',
+        help="Override a setting, e.g. Buckets.TwoPhaseSync=true"
+    )
+    parser.add_argument(
+        '--api', action='store_true',
+        help="Synchronize online against the local stand-in of Splitwise "
+             "instead of offline."
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help="With --api, seconds that every request takes."
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help="With --api, up to this many seconds more or less per request."
+    )
+    parser.add_argument(
+        '--rate-limited', type=float, default=0.0,
+        help="With --api, ratio (0 to 1) of requests answered with a 429."
+    )
+    parser.add_argument(
+        '--statements-per-expense', type=int,
+        help="Fail the expenses whose handle_expense runs more SQL "
+             "statements than this."
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None, prog=None):
+    from tabulate import tabulate
+
+    args = parse_args(argv, prog)
+    api = None
+    if args.api:
+        api = {
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'rate_limited': args.rate_limited,
+        }
+    results = []
+    for expenses, transactions in itertools.product(
+            args.expenses, args.transactions):
+        # A new process each time so the peak memory is only this run's.
+        with ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context('spawn')
+        ) as executor:
+            result = executor.submit(
+                measure, expenses, transactions, args.setting, args.seed, api,
+                args.statements_per_expense
+            ).result()
+        results.append(result)
+        print(f"{expenses} expenses, {transactions} transactions: "
+              f"{result['expenses/s']:.0f} expenses/s")
+    print(tabulate(
+        [list(result.values()) for result in results],
+        list(results[0].keys()), tablefmt="fancy_grid", floatfmt=".2f"
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,18 @@
 import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
 
+from budget_indexes import IndexManager
+from metrics import Metrics, statement_kind
+from pragma_profile import PragmaProfile
 from settings import config
+from sql_profiler import SqlProfiler
+from sync_plan import SyncPlan
 
-debug = config['debug'].get()
+# Views, only read when a BucketManager is created so the module can be
+# imported without a config.yaml.
+debug = config['debug']
 config = config['Buckets']
 
 
@@ -48,6 +58,9 @@ class BucketManager:
 
     The empty string in general_cat means it's an expense.
 
+    Amounts are integer cents, like Buckets stores them, all the way from
+    SplitwiseToBucketsSynch.get_expense_obj.
+
     As iffy pointed out here https://github.com/buckets/application/issues/507
     We also need to access the 'account' table in order to get the Splitwise
     account ID.
@@ -70,29 +83,363 @@ class BucketManager:
         offbudget TINYINT DEFAULT 0
         kind TEXT DEFAULT ''
 
+    With the PrefetchTransactions setting enabled, all the transactions with
+    a fi_id in the configured accounts, and their bucket transactions, are
+    loaded into memory at start-up and the lookups done while synchronizing
+    are answered from there. The index is kept up to date by the methods that
+    write, so the per-expense path doesn't need to read from the database.
+
+    With BatchedWrites enabled, the synchronization runs inside batch(): a
+    single transaction in which every expense gets its own SAVEPOINT, so a
+    failing expense only rolls back its own rows. It's committed at the end,
+    or every CommitEvery expenses.
+
+    See start_plan() for the two-phase synchronization.
+
+    Every statement goes through execute(), which counts it in the Metrics
+    as a Buckets read (SELECT) or write (everything else) and, in debug mode
+    or with SqlProfile, in the SqlProfiler.
     """
-    def __init__(self):
-        self.connection = sqlite3.connect(config['BudgetFilePath'].get())
-        if debug:
-            self.connection.set_trace_callback(print)
+    # Columns selected when prefetching, in the same order as the scheme above
+    # so the rows can be accessed by the same indexes as the SELECT * ones.
+    transaction_columns = (
+        'id, created, posted, account_id, amount, memo, fi_id, general_cat, '
+        'notes, cleared'
+    )
+    bucket_transaction_columns = (
+        'id, created, posted, bucket_id, amount, memo, account_trans_id'
+    )
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Without SQLite's own waiting when the file is locked, see
+        # retry_when_locked.
+        self.connection = sqlite3.connect(
+            config['BudgetFilePath'].get(), timeout=0
+        )
+        self.profiler = None
+        if debug.get() or config['SqlProfile'].get():
+            self.profiler = SqlProfiler()
+        if config['ManagedIndexes'].get():
+            self.retry_when_locked(IndexManager(self.connection).create)
         self.cursor = self.connection.cursor()
+        self.data_version = self.get_data_version()
+        self.account_ids = {}
+        self.bucket_ids = {}
+        self.load_ids()
+
+        self.batched = False
+        self.batch_size = 0
+        self.plan = None
+        # fi_ids of the deleted expenses, whose rows are removed all at once
+        # by delete_pending_expenses.
+        self.pending_deletes = set()
+
+        self.indexed = False
+        # {trans_id: row}
+        self.account_transactions = {}
+        # {(fi_id, account_id): [trans_id, ...]}
+        self.fi_id_index = {}
+        # {account_trans_id: [row, ...]}
+        self.bucket_transactions = {}
+        if config['PrefetchTransactions'].get():
+            self.load_transactions_index()
+
+    def load_ids(self):
         self.account_ids = {}
         for keyword, account_name in config['AccountsKeywords'].get().items():
             self.account_ids.update({
                 keyword: self.get_account_id(account_name)
             })
         cmd = f"SELECT * FROM bucket WHERE id > 0"
-        self.cursor.execute(cmd)
-        results = self.cursor.fetchall()
+        results = self.execute(cmd)
         self.bucket_ids = {}
         if len(results) > 0:
             for bucket in results:
                 self.bucket_ids.update({bucket[2]: bucket[0]})
 
+    def get_data_version(self):
+        # Changes whenever another connection, like Buckets itself, commits
+        # something to the file.
+        return self.retry_when_locked(
+            self.connection.execute, "PRAGMA data_version"
+        ).fetchone()[0]
+
+    def refresh(self):
+        """
+        For long-running synchronizations (see watch.py): if the budget file
+        was changed by someone else since the last time, reloads the account
+        and bucket ids and, if it's loaded, the transactions index.
+
+        :return: True if it was reloaded.
+        """
+        data_version = self.get_data_version()
+        if data_version == self.data_version:
+            return False
+        self.data_version = data_version
+        self.load_ids()
+        if self.indexed:
+            self.load_transactions_index()
+        return True
+
+    def load_transactions_index(self):
+        """
+        Loads every transaction of the configured accounts that has a fi_id,
+        and the bucket transactions linked to them, in two queries.
+        """
+        self.account_transactions = {}
+        self.fi_id_index = {}
+        self.bucket_transactions = {}
+
+        account_ids = list(self.account_ids.values())
+        placeholders = ','.join(['?'] * len(account_ids))
+        cmd = (f"SELECT {self.transaction_columns} FROM account_transaction "
+               f"WHERE account_id IN ({placeholders}) "
+               f"   AND fi_id IS NOT NULL AND fi_id != ''")
+        for row in self.execute(cmd, account_ids):
+            self.index_transaction(row)
+
+        columns = ', '.join(
+            f"bt.{column}"
+            for column in self.bucket_transaction_columns.split(', ')
+        )
+        cmd = (f"SELECT {columns} FROM bucket_transaction bt "
+               f"JOIN account_transaction t ON t.id = bt.account_trans_id "
+               f"WHERE t.account_id IN ({placeholders}) "
+               f"   AND t.fi_id IS NOT NULL AND t.fi_id != ''")
+        for row in self.execute(cmd, account_ids):
+            self.bucket_transactions.setdefault(row[6], []).append(row)
+        self.indexed = True
+
+    def execute(self, cmd, values=(), many=False):
+        """
+        Runs the statement (with executemany if many) on self.cursor.
+
+        :return: all the rows for a SELECT, None otherwise. lastrowid and
+        rowcount are still in self.cursor.
+        """
+        kind = statement_kind(cmd)
+        phase = 'buckets_reads' if kind == 'SELECT' else 'buckets_writes'
+        rows = None
+        start = time.perf_counter()
+        with self.metrics.phase(phase):
+            if many:
+                self.retry_when_locked(self.cursor.executemany, cmd, values)
+            else:
+                self.retry_when_locked(self.cursor.execute, cmd, values)
+            if kind == 'SELECT':
+                rows = self.cursor.fetchall()
+        count = len(rows) if rows is not None else self.cursor.rowcount
+        self.metrics.count_statement(phase, kind, count)
+        if self.profiler is not None:
+            self.profiler.record(cmd, time.perf_counter() - start, count)
+        return rows
+
+    def retry_when_locked(self, method, *args):
+        """
+        Calls method, and while the budget file is locked by someone else
+        (like the Buckets app saving it) tries again, for up to
+        BusyTimeoutSeconds, waiting LockBackoffSeconds the first time and
+        twice as long every time after that. The connection doesn't wait by
+        itself (its timeout is 0), so every wait, from the first time it was
+        found locked until it went through or gave up, is counted in the
+        Metrics as a lock wait.
+        """
+        timeout = config['BusyTimeoutSeconds'].get()
+        backoff = config['LockBackoffSeconds'].get()
+        locked_since = None
+        attempt = 0
+        while True:
+            try:
+                result = method(*args)
+            except sqlite3.OperationalError as e:
+                if 'is locked' not in str(e):
+                    raise
+                now = time.perf_counter()
+                if locked_since is None:
+                    locked_since = now
+                remaining = locked_since + timeout - now
+                if remaining <= 0:
+                    self.metrics.count_lock_wait(now - locked_since)
+                    raise
+                time.sleep(min(backoff * 2 ** attempt, remaining))
+                attempt += 1
+                continue
+            if locked_since is not None:
+                self.metrics.count_lock_wait(
+                    time.perf_counter() - locked_since
+                )
+            return result
+
+    @contextmanager
+    def tuned(self):
+        """
+        Sets the Pragmas on the connection until the end of the block, and
+        then puts back the ones it had.
+        """
+        profile = PragmaProfile(self.connection, config['Pragmas'].get() or {})
+        profile.apply()
+        try:
+            yield
+        finally:
+            profile.restore()
+
+    def commit_transaction(self):
+        start = time.perf_counter()
+        with self.metrics.phase('buckets_writes'):
+            self.retry_when_locked(self.connection.commit)
+        self.metrics.count_statement('buckets_writes', 'COMMIT')
+        if self.profiler is not None:
+            self.profiler.record('COMMIT', time.perf_counter() - start)
+
+    def report_sql_profile(self):
+        """
+        Writes the SqlProfiler's summary to SqlProfilePath or, without it,
+        prints it.
+        """
+        if self.profiler is None:
+            return
+        path = config['SqlProfilePath'].get()
+        if path:
+            self.profiler.write_csv(path)
+        else:
+            self.profiler.print_summary()
+
+    def commit(self):
+        # Inside a batch the commits are handled by batch/expense_savepoint.
+        if not self.batched:
+            self.commit_transaction()
+
+    @contextmanager
+    def batch(self):
+        if self.plan is not None or not config['BatchedWrites'].get():
+            yield
+            return
+        self.commit_transaction()
+        # Taking the write lock right away, so waiting for it (see
+        # retry_when_locked) happens here and not halfway through, when
+        # SQLite may give up to avoid a deadlock.
+        self.execute("BEGIN IMMEDIATE")
+        self.batched = True
+        self.batch_size = 0
+        try:
+            yield
+        finally:
+            # Whatever expenses made it through their savepoint are kept.
+            self.batched = False
+            self.commit_transaction()
+
+    @contextmanager
+    def expense_savepoint(self, fi_id):
+        """
+        Wraps the writes of a single expense. If anything fails, its rows
+        (and its entries in the index) are rolled back, and the exception is
+        raised again so it ends up in the report.
+        """
+        if self.plan is not None:
+            snapshot = self.snapshot_index(fi_id)
+            mark = self.plan.mark()
+            try:
+                yield
+            except BaseException:
+                self.plan.rollback_to(mark)
+                self.restore_index(fi_id, snapshot)
+                raise
+            return
+        if not self.batched:
+            yield
+            return
+        snapshot = self.snapshot_index(fi_id)
+        self.execute("SAVEPOINT expense")
+        try:
+            yield
+        except BaseException:
+            self.execute("ROLLBACK TO SAVEPOINT expense")
+            self.execute("RELEASE SAVEPOINT expense")
+            self.restore_index(fi_id, snapshot)
+            raise
+        self.execute("RELEASE SAVEPOINT expense")
+        self.batch_size += 1
+        commit_every = config['CommitEvery'].get()
+        if commit_every and self.batch_size >= commit_every:
+            self.commit_transaction()
+            self.execute("BEGIN IMMEDIATE")
+            self.batch_size = 0
+
+    def snapshot_index(self, fi_id):
+        if not self.indexed:
+            return None
+        rows = self.get_indexed_transactions(fi_id, self.account_ids.values())
+        return [(row, self.bucket_transactions.get(row[0])) for row in rows]
+
+    def restore_index(self, fi_id, snapshot):
+        if snapshot is None:
+            return
+        self.unindex_fi_id(fi_id)
+        for row, bucket_rows in snapshot:
+            self.index_transaction(row)
+            if bucket_rows is not None:
+                self.bucket_transactions[row[0]] = bucket_rows
+
+    @staticmethod
+    def index_key(fi_id, account_id):
+        # fi_id is a TEXT column, Splitwise gives us integers.
+        return str(fi_id), account_id
+
+    def index_transaction(self, row):
+        trans_id = row[0]
+        previous = self.account_transactions.get(trans_id)
+        if previous is not None:
+            key = self.index_key(previous[6], previous[3])
+            self.fi_id_index[key].remove(trans_id)
+            if not self.fi_id_index[key]:
+                del self.fi_id_index[key]
+        self.account_transactions[trans_id] = row
+        key = self.index_key(row[6], row[3])
+        self.fi_id_index.setdefault(key, []).append(trans_id)
+
+    def unindex_fi_id(self, fi_id):
+        for account_id in self.account_ids.values():
+            key = self.index_key(fi_id, account_id)
+            for trans_id in self.fi_id_index.pop(key, []):
+                del self.account_transactions[trans_id]
+                self.bucket_transactions.pop(trans_id, None)
+
+    def get_indexed_transactions(self, fi_id, account_ids):
+        trans_ids = []
+        for account_id in account_ids:
+            trans_ids.extend(
+                self.fi_id_index.get(self.index_key(fi_id, account_id), [])
+            )
+        return [self.account_transactions[i] for i in sorted(trans_ids)]
+
+    def get_transaction_ids_by_fi_id(self, fi_id):
+        """
+        :return: ids of the expense's transactions, to tell later with
+        has_transactions whether they're still there. Only with the
+        prefetched index, without it they'd be a query per expense.
+        """
+        if fi_id in self.pending_deletes:
+            return []
+        return [
+            t[0] for t in self.get_indexed_transactions(
+                fi_id, self.account_ids.values()
+            )
+        ]
+
+    def has_transactions(self, trans_ids):
+        """
+        Without the prefetched index there's no cheap way to know, so they're
+        taken as missing, and the expense is synchronized again like before
+        there were fingerprints.
+        """
+        if not self.indexed:
+            return False
+        return all(i in self.account_transactions for i in trans_ids)
+
     def get_account_id(self, acc_name):
         cmd = f"SELECT * FROM account WHERE name='{acc_name}'"
-        self.cursor.execute(cmd)
-        results = self.cursor.fetchall()
+        results = self.execute(cmd)
         if len(results) < 1:
             raise MissingSpliwiseAccount(
                 "In your BUCKETS_PAYMENTS_ACCOUNT settings you specified"
@@ -102,11 +449,20 @@ class BucketManager:
         return results[0][0]
 
     def get_transfer_transactions_by_fi_id(self, fi_id):
+        if self.indexed:
+            # Only transfers involving the configured accounts are indexed,
+            # which are the only ones this script creates.
+            return [
+                t for t in self.get_indexed_transactions(
+                    fi_id, self.account_ids.values()
+                )
+                # [7] is general_cat
+                if t[7] == 'transfer'
+            ]
         cmd = (f"SELECT * FROM account_transaction "
                f"WHERE fi_id=? AND general_cat=?")
         values = (fi_id, 'transfer')
-        self.cursor.execute(cmd, values)
-        return self.cursor.fetchall()
+        return self.execute(cmd, values)
 
     def get_expense_transactions_by_fi_id(self, fi_id, account):
         if account in ('cash', 'payment'):
@@ -120,6 +476,11 @@ class BucketManager:
                 "Calling get_expense_transactions_by_fi_id with an account "
                 "that's not cash, payment or splitwise."
             )
+        if self.indexed:
+            return [
+                t for t in self.get_indexed_transactions(fi_id, acc_v)
+                if t[7] is None or t[7] == ''
+            ]
         cmd = (f"SELECT * FROM account_transaction "
                f"WHERE "
                f"   fi_id=? "
@@ -127,14 +488,14 @@ class BucketManager:
                f"   {acc_q}")
         values = [fi_id, ]
         values.extend(acc_v)
-        self.cursor.execute(cmd, values)
-        return self.cursor.fetchall()
+        return self.execute(cmd, values)
 
     def get_bucket_transaction_by_account_trans_id(self, account_trans_id):
+        if self.indexed:
+            return self.bucket_transactions.get(account_trans_id, [])
         cmd = f"SELECT * FROM bucket_transaction WHERE account_trans_id=?"
         values = (account_trans_id, )
-        self.cursor.execute(cmd, values)
-        return self.cursor.fetchall()
+        return self.execute(cmd, values)
 
     """
     Managing transfers
@@ -320,16 +681,24 @@ class BucketManager:
         )
         """
         values = (
-            date,
+            self.date_to_bk_posted(date),
             self.account_ids[account_id],
-            self.decimal_to_bk_amount(amount),
+            amount,
             memo,
             fi_id,
             general_cat
         )
-        self.cursor.execute(cmd, values)
-        self.connection.commit()
-        created_id = self.cursor.lastrowid
+        if self.plan is not None:
+            created_id = self.plan.next_transaction_id()
+            self.plan.transaction_inserts.append((created_id, ) + values)
+        else:
+            self.execute(cmd, values)
+            self.commit()
+            created_id = self.cursor.lastrowid
+        if self.indexed:
+            self.index_transaction((created_id, None) + values[:-1] + (
+                general_cat, '', 0
+            ))
         return created_id
 
     def update_account_transaction(
@@ -347,18 +716,33 @@ class BucketManager:
             id = ?
         """
         values = (
-            date,
+            self.date_to_bk_posted(date),
             self.account_ids[account_id],
-            self.decimal_to_bk_amount(amount),
+            amount,
             memo,
             general_cat,
             trans_id
         )
-        self.cursor.execute(cmd, values)
-        self.connection.commit()
-        if self.cursor.rowcount < 0:
-            raise TransferTransactionUpdateFailed(
-                f"Failed to update the transaction {id=}"
+        row = None
+        if self.indexed and trans_id in self.account_transactions:
+            row = self.account_transactions[trans_id]
+            if row[2:6] + row[7:8] == values[:5]:
+                if self.plan is not None:
+                    self.plan.unchanged_transactions += 1
+                return
+
+        if self.plan is not None:
+            self.plan.transaction_updates.append(values)
+        else:
+            self.execute(cmd, values)
+            self.commit()
+            if self.cursor.rowcount < 0:
+                raise TransferTransactionUpdateFailed(
+                    f"Failed to update the transaction {id=}"
+                )
+        if row is not None:
+            self.index_transaction(
+                row[:2] + values[:4] + (row[6], general_cat) + row[8:]
             )
 
     def get_bucket_id(self, bucket_name):
@@ -368,6 +752,7 @@ class BucketManager:
             return None
 
     def categorize_transaction(self, bucket_id, date, amount, memo, trans_id):
+        date = self.date_to_bk_posted(date)
         existing = self.get_bucket_transaction_by_account_trans_id(trans_id)
         if len(existing) == 0:
             # Creating a bucket_transaction without bucket_id is possible but
@@ -389,9 +774,22 @@ class BucketManager:
                 ?
             )
             """
-            values = (date, bucket_id, self.decimal_to_bk_amount(amount),
-                      memo, trans_id)
+            values = (date, bucket_id, amount, memo, trans_id)
+            planned = 'bucket_inserts'
         else:
+            if self.indexed and all(
+                row[2:6] == (
+                    date,
+                    row[3] if bucket_id is None else bucket_id,
+                    amount,
+                    memo
+                )
+                for row in existing
+            ):
+                if self.plan is not None:
+                    self.plan.unchanged_bucket_transactions += 1
+                return
+
             if bucket_id is None:
                 # User might've changed the bucket manually, leaving bucket_id
                 # alone.
@@ -404,8 +802,8 @@ class BucketManager:
                 WHERE
                     account_trans_id = ?
                 """
-                values = (date, self.decimal_to_bk_amount(amount), memo,
-                          trans_id)
+                values = (date, amount, memo, trans_id)
+                planned = 'bucket_updates'
             else:
                 # We cannot know if the user changed the bucket manually or
                 # not. So, if a valid bucket can be resolved from
@@ -420,41 +818,215 @@ class BucketManager:
                 WHERE
                     account_trans_id = ?
                 """
-                values = (date, bucket_id, self.decimal_to_bk_amount(amount),
-                          memo, trans_id)
-        self.cursor.execute(cmd, values)
-        self.connection.commit()
+                values = (date, bucket_id, amount, memo, trans_id)
+                planned = 'bucket_recategorizations'
+        if self.plan is not None:
+            getattr(self.plan, planned).append(values)
+            created_id = None
+        else:
+            self.execute(cmd, values)
+            self.commit()
+            created_id = self.cursor.lastrowid
+        if self.indexed:
+            if len(existing) == 0:
+                self.bucket_transactions[trans_id] = [
+                    (created_id, None) + values
+                ]
+            else:
+                self.bucket_transactions[trans_id] = [
+                    row[:2] + (
+                        date,
+                        row[3] if bucket_id is None else bucket_id,
+                        amount,
+                        memo
+                    ) + row[6:]
+                    for row in existing
+                ]
 
     def delete_expense(self, expense):
-        cmd = f"SELECT * FROM account_transaction WHERE fi_id=?"
-        values = (expense.id, )
-        self.cursor.execute(cmd, values)
-        transactions = self.cursor.fetchall()
-        trans_ids = []
-        for transaction in transactions:
-            if transaction[7] != 'transfer':
-                trans_ids.append(transaction[0])
-        if len(trans_ids) > 0:
-            print(trans_ids)
-            cmd = (f"DELETE FROM bucket_transaction WHERE account_trans_id "
-                   f"in ({','.join(['?']*len(trans_ids))})")
-            print(cmd)
-            self.cursor.execute(cmd, trans_ids)
-            self.cursor.fetchall()
-        cmd = "DELETE FROM account_transaction WHERE fi_id = ?"
-        values = (expense.id, )
-        self.cursor.execute(cmd, values)
-        self.cursor.fetchall()
+        """
+        Only takes note of the expense, its rows are removed together with
+        the ones of the rest of the deleted expenses by
+        delete_pending_expenses (or apply_plan).
+        """
+        if self.plan is not None:
+            transactions = self.get_indexed_transactions(
+                expense.id, self.account_ids.values()
+            )
+            if transactions:
+                self.plan.deletes.append((expense.id, ))
+                self.plan.deleted_transactions += len(transactions)
+                self.plan.deleted_bucket_transactions += sum(
+                    len(self.bucket_transactions.get(transaction[0], []))
+                    for transaction in transactions
+                    if transaction[7] != 'transfer'
+                )
+            self.unindex_fi_id(expense.id)
+            return
+
+        self.pending_deletes.add(expense.id)
+        if self.indexed:
+            self.unindex_fi_id(expense.id)
+
+    def delete_pending_expenses(self):
+        """
+        Removes the rows of all the expenses passed to delete_expense since
+        the last time, and commits.
+
+        :return: {fi_id: (account_transaction rows, bucket_transaction rows)}
+        removed, only for the expenses that had any.
+        """
+        if not self.pending_deletes:
+            return {}
+        fi_ids = self.pending_deletes
+        self.pending_deletes = set()
+        removed = self.delete_fi_ids(fi_ids)
+        self.commit()
+        return removed
+
+    def delete_fi_ids(self, fi_ids):
+        """
+        Removes the account transactions with the given fi_ids, and the
+        bucket transactions of the ones that aren't transfers, in a few
+        statements no matter how many they are.
+
+        :return: like delete_pending_expenses.
+        """
+        self.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS deleted_expense (
+                fi_id TEXT PRIMARY KEY
+            )
+        """)
+        self.execute("DELETE FROM temp.deleted_expense")
+        self.execute(
+            "INSERT OR IGNORE INTO temp.deleted_expense (fi_id) VALUES (?)",
+            [(fi_id, ) for fi_id in fi_ids], many=True
+        )
+        rows = self.execute("""
+            SELECT t.fi_id, COUNT(DISTINCT t.id), COUNT(bt.id)
+            FROM account_transaction t
+            LEFT JOIN bucket_transaction bt
+                ON bt.account_trans_id = t.id
+                AND t.general_cat IS NOT 'transfer'
+            WHERE t.fi_id IN (SELECT fi_id FROM temp.deleted_expense)
+            GROUP BY t.fi_id
+        """)
+        self.execute("""
+            DELETE FROM bucket_transaction
+            WHERE account_trans_id IN (
+                SELECT id FROM account_transaction
+                WHERE fi_id IN (SELECT fi_id FROM temp.deleted_expense)
+                    AND general_cat IS NOT 'transfer'
+            )
+        """)
+        self.execute("""
+            DELETE FROM account_transaction
+            WHERE fi_id IN (SELECT fi_id FROM temp.deleted_expense)
+        """)
+        self.execute("DELETE FROM temp.deleted_expense")
+        return {
+            int(fi_id): (transactions, bucket_transactions)
+            for fi_id, transactions, bucket_transactions in rows
+        }
+
+    """
+    Two-phase synchronization
+    With start_plan() the methods above don't write anything, they add the
+    changes to a SyncPlan (skipping the ones that wouldn't change anything) and
+    then apply_plan() writes all of them at once.
+    """
+    def start_plan(self):
+        if not self.indexed:
+            self.load_transactions_index()
+        rows = self.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM account_transaction"
+        )
+        self.plan = SyncPlan(rows[0][0])
+        return self.plan
+
+    def apply_plan(self):
+        plan = self.plan
+        self.plan = None
+        self.commit_transaction()
+        try:
+            # Nobody else can write from now on, so if the file got new rows
+            # since the plan was started, the planned ids are moved after them
+            # just once.
+            self.execute("BEGIN IMMEDIATE")
+            rows = self.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM account_transaction"
+            )
+            offset = rows[0][0] - plan.first_transaction_id
+            if offset > 0:
+                plan.shift_transaction_ids(offset)
+            self.execute(
+                """
+                INSERT INTO account_transaction (
+                    id, posted, account_id, amount, memo, fi_id, general_cat
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                plan.transaction_inserts, many=True
+            )
+            self.execute(
+                """
+                UPDATE account_transaction
+                SET posted = ?, account_id = ?, amount = ?, memo = ?,
+                    general_cat = ?
+                WHERE id = ?
+                """,
+                plan.transaction_updates, many=True
+            )
+            self.execute(
+                """
+                INSERT INTO bucket_transaction (
+                    posted, bucket_id, amount, memo, account_trans_id
+                )
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                plan.bucket_inserts, many=True
+            )
+            self.execute(
+                """
+                UPDATE bucket_transaction
+                SET posted = ?, amount = ?, memo = ?
+                WHERE account_trans_id = ?
+                """,
+                plan.bucket_updates, many=True
+            )
+            self.execute(
+                """
+                UPDATE bucket_transaction
+                SET posted = ?, bucket_id = ?, amount = ?, memo = ?
+                WHERE account_trans_id = ?
+                """,
+                plan.bucket_recategorizations, many=True
+            )
+            if plan.deletes:
+                plan.removed_rows = self.delete_fi_ids(
+                    [fi_id for fi_id, in plan.deletes]
+                )
+        except Exception:
+            self.connection.rollback()
+            # The index already contains the planned changes.
+            self.load_transactions_index()
+            raise
+        self.commit_transaction()
+        if plan.transaction_id_offset:
+            # It has the planned ids, not the ones they ended up with.
+            self.load_transactions_index()
+        return plan
 
     @staticmethod
-    def decimal_to_bk_amount(amount):
-        if amount is not float:
-            amount = float(amount)
-        return int(round(amount * 100))
+    def date_to_bk_posted(date):
+        # The same string that sqlite3 stores for a datetime, done beforehand
+        # to be able to compare it with the existing rows.
+        if isinstance(date, datetime):
+            return date.isoformat(" ")
+        return date
 
     def test(self):
         cmd = "SELECT * FROM account_transaction"
-        self.cursor.execute(cmd)
-        results = self.cursor.fetchall()
+        results = self.execute(cmd)
 
         print(results)
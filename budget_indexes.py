@@ -0,0 +1,193 @@
+"""
+Indexes that the synchronization adds to the budget file, because the columns
+it looks up the transactions by aren't indexed in Buckets' schema.
+
+Opt-in with the Buckets.ManagedIndexes setting, or running:
+
+    python budget_indexes.py create
+    python budget_indexes.py drop
+    python budget_indexes.py check
+
+which also show how SQLite plans the lookups before and after.
+"""
+import argparse
+import sqlite3
+import textwrap
+
+from settings import config
+
+config = config['Buckets']
+
+# Prefixed so they can't clash with Buckets' own indexes, and only these are
+# ever dropped.
+INDEXES = {
+    'splitwise_account_transaction_fi_id': (
+        'account_transaction', ('fi_id', 'general_cat', 'account_id')
+    ),
+    'splitwise_bucket_transaction_account_trans_id': (
+        'bucket_transaction', ('account_trans_id', )
+    ),
+}
+
+# The lookups of BucketManager that the indexes are for, when the
+# transactions aren't prefetched, with their number of parameters. The
+# deleted expenses are looked up through the temp.deleted_expense table that
+# BucketManager.delete_fi_ids fills.
+LOOKUPS = (
+    ("SELECT * FROM account_transaction WHERE fi_id=? AND general_cat=?", 2),
+    ("SELECT * FROM account_transaction WHERE fi_id=? "
+     "AND (general_cat IS NULL OR general_cat = '') AND account_id IN (?, ?)",
+     3),
+    ("SELECT * FROM bucket_transaction WHERE account_trans_id=?", 1),
+    ("UPDATE bucket_transaction SET posted = ?, bucket_id = ?, amount = ?, "
+     "memo = ? WHERE account_trans_id = ?", 5),
+    ("SELECT t.fi_id, COUNT(DISTINCT t.id), COUNT(bt.id) "
+     "FROM account_transaction t LEFT JOIN bucket_transaction bt "
+     "ON bt.account_trans_id = t.id AND t.general_cat IS NOT 'transfer' "
+     "WHERE t.fi_id IN (SELECT fi_id FROM temp.deleted_expense) "
+     "GROUP BY t.fi_id", 0),
+    ("DELETE FROM bucket_transaction WHERE account_trans_id IN ("
+     "SELECT id FROM account_transaction "
+     "WHERE fi_id IN (SELECT fi_id FROM temp.deleted_expense) "
+     "AND general_cat IS NOT 'transfer')", 0),
+    ("DELETE FROM account_transaction "
+     "WHERE fi_id IN (SELECT fi_id FROM temp.deleted_expense)", 0),
+)
+
+
+class IncompatibleBudgetSchema(Exception):
+    pass
+
+
+class IndexManager:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_schema_version(self):
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def check_schema(self):
+        """
+        Makes sure that the budget file is one the indexes were made for
+        before touching it: the schema version has to be the configured
+        ManagedIndexesSchemaVersion and the indexed columns have to be there.
+        """
+        version = self.get_schema_version()
+        expected = config['ManagedIndexesSchemaVersion'].get()
+        if expected is None:
+            raise IncompatibleBudgetSchema(
+                f"ManagedIndexesSchemaVersion isn't set, so it can't be known "
+                f"if the indexes fit this budget file. Its schema version is "
+                f"{version}: check the query plans with 'python "
+                f"budget_indexes.py check' and set it to that."
+            )
+        if version != expected:
+            raise IncompatibleBudgetSchema(
+                f"The budget file's schema version is {version} but "
+                f"ManagedIndexesSchemaVersion is {expected}. Buckets might "
+                f"have changed its format, check that the indexes still make "
+                f"sense before updating the setting."
+            )
+        for name, (table, columns) in INDEXES.items():
+            existing = {
+                row[1] for row in self.connection.execute(
+                    f"PRAGMA table_info({table})"
+                )
+            }
+            missing = [column for column in columns if column not in existing]
+            if missing:
+                raise IncompatibleBudgetSchema(
+                    f"The budget file's {table} table doesn't have the "
+                    f"columns {', '.join(missing)}, the index {name} can't "
+                    f"be created."
+                )
+
+    def get_existing(self):
+        return {
+            row[0] for row in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        }
+
+    def create(self):
+        """
+        :return: names of the indexes that didn't exist.
+        """
+        self.check_schema()
+        created = [name for name in INDEXES if name not in self.get_existing()]
+        for name in created:
+            table, columns = INDEXES[name]
+            self.connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {name} "
+                f"ON {table} ({', '.join(columns)})"
+            )
+        self.connection.commit()
+        return created
+
+    def drop(self):
+        """
+        Whatever the schema, only the indexes in INDEXES are ever dropped.
+
+        :return: names of the indexes that existed.
+        """
+        dropped = [name for name in INDEXES if name in self.get_existing()]
+        for name in dropped:
+            self.connection.execute(f"DROP INDEX IF EXISTS {name}")
+        self.connection.commit()
+        return dropped
+
+    def get_query_plans(self):
+        """
+        :return: {lookup: how SQLite plans to run it}
+        """
+        # Like BucketManager.delete_fi_ids creates it, it's gone with the
+        # connection.
+        self.connection.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS deleted_expense (
+                fi_id TEXT PRIMARY KEY
+            )
+        """)
+        plans = {}
+        for lookup, parameters in LOOKUPS:
+            rows = self.connection.execute(
+                f"EXPLAIN QUERY PLAN {lookup}", (None, ) * parameters
+            )
+            plans[lookup] = '\n'.join(row[-1] for row in rows)
+        return plans
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Manage the indexes that the synchronization adds to "
+                    "the budget file."
+    )
+    parser.add_argument(
+        'action', choices=['create', 'drop', 'check'],
+        help="check only shows the schema version and the query plans."
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from tabulate import tabulate
+
+    args = parse_args()
+    # Without caching the statements, otherwise the query plans after
+    # creating or dropping the indexes would be the cached ones from before.
+    manager = IndexManager(sqlite3.connect(
+        config['BudgetFilePath'].get(), cached_statements=0
+    ))
+    print(f"Budget file schema version: {manager.get_schema_version()}")
+    before = manager.get_query_plans()
+    if args.action == 'create':
+        print(f"Created indexes: {manager.create() or 'none'}")
+    elif args.action == 'drop':
+        print(f"Dropped indexes: {manager.drop() or 'none'}")
+    after = manager.get_query_plans()
+    print(tabulate(
+        [
+            (textwrap.fill(lookup, 50), before[lookup], after[lookup])
+            for lookup, parameters in LOOKUPS
+        ],
+        ['lookup', 'before', 'after'], tablefmt="fancy_grid"
+    ))
@@ -0,0 +1,102 @@
+"""
+Single entry point for everything this project does:
+
+    python cli.py sync [synch.py's options]
+    python cli.py auth
+    python cli.py categories
+    python cli.py benchmark {sync,import-time} [options]
+
+Only what the chosen subcommand needs is imported, so a cron job running
+'python cli.py sync --offline' doesn't load Flask, nor the Splitwise client,
+and 'python cli.py --help' loads nothing but argparse. See
+'python cli.py benchmark import-time'.
+"""
+import argparse
+import importlib
+
+BENCHMARKS = {
+    'sync': 'benchmarks.run',
+    'import-time': 'benchmarks.import_time',
+}
+
+
+def sync(argv, prog):
+    import synch
+    synch.main(argv, prog)
+
+
+def auth():
+    import authenticate
+    authenticate.main()
+
+
+def categories(refresh):
+    """
+    Prints every Splitwise category, ready to be pasted as
+    SplitwiseCategoriesToBucketNames in config.yaml.
+    """
+    from splitwise_manager import SplitWiseManager
+    sw = SplitWiseManager()
+    sw.authenticate()
+    sw.print_categories_dict(refresh)
+
+
+def benchmark(name, argv, prog):
+    importlib.import_module(BENCHMARKS[name]).main(argv, prog)
+
+
+def parse_args(argv=None):
+    """
+    :return: (parser, arguments, the rest of them) where the rest are the
+    options of the subcommands that have their own parser (sync and
+    benchmark), which are left to it, help included.
+    """
+    parser = argparse.ArgumentParser(
+        description="Synchronize your Splitwise expenses into your Buckets' "
+                    "budget."
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+    subparsers.add_parser(
+        'sync', add_help=False,
+        help="Synchronize the expenses, 'sync --help' for its options."
+    )
+    subparsers.add_parser(
+        'auth', help="Obtain the Splitwise token, through the browser."
+    )
+    categories_parser = subparsers.add_parser(
+        'categories',
+        help="Print the Splitwise categories to fill in "
+             "SplitwiseCategoriesToBucketNames."
+    )
+    categories_parser.add_argument(
+        '--refresh', action='store_true',
+        help="Ask Splitwise for them even if they're in the SessionCache."
+    )
+    benchmark_parser = subparsers.add_parser(
+        'benchmark', add_help=False,
+        help="Run one of the benchmarks, 'benchmark NAME --help' for its "
+             "options."
+    )
+    benchmark_parser.add_argument('name', choices=sorted(BENCHMARKS))
+    args, rest = parser.parse_known_args(argv)
+    if rest and args.command not in ('sync', 'benchmark'):
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    return parser, args, rest
+
+
+def main(argv=None):
+    parser, args, rest = parse_args(argv)
+    prog = f"{parser.prog} {args.command}"
+    if args.command == 'sync':
+        sync(rest, prog)
+    elif args.command == 'auth':
+        auth()
+    elif args.command == 'categories':
+        categories(args.refresh)
+    elif args.command == 'benchmark':
+        benchmark(args.name, rest, f"{prog} {args.name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,440 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from settings import config
+
+
+def connect(path=None, check_same_thread=True):
+    """
+    Opens the SQLite file, next to config.yaml, where the data worth keeping
+    between runs is stored. It's only a cache: it can be deleted at any time.
+    """
+    if path is None:
+        path = os.path.join(config.config_dir(), config['LocalStorePath'].get())
+    return sqlite3.connect(path, check_same_thread=check_same_thread)
+
+
+class CommentCache:
+    """
+    Remembers, for each expense, whether the current user commented it with
+    the ExpensesCashKeyword, so its comments aren't retrieved again in every
+    run.
+
+    An entry is only valid while the expense has the same updated_at and the
+    same number of comments than when it was cached.
+    """
+    def __init__(self, connection, user_id):
+        self.connection = connection
+        self.user_id = user_id
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS comment_cache (
+                user_id INTEGER,
+                expense_id INTEGER,
+                updated_at TEXT,
+                comments_count INTEGER,
+                is_cash TINYINT,
+                cached_at REAL,
+                PRIMARY KEY (user_id, expense_id)
+            )
+        """)
+        self.connection.commit()
+
+    def get(self, expense):
+        """
+        :return: True or False if the expense is cached and hasn't changed,
+        None otherwise.
+        """
+        cursor = self.connection.execute(
+            """
+            SELECT is_cash FROM comment_cache
+            WHERE user_id = ? AND expense_id = ? AND updated_at = ?
+                AND comments_count = ?
+            """,
+            (self.user_id, expense.getId(), expense.getUpdatedAt(),
+             expense.getCommentsCount())
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return bool(row[0])
+
+    def set_many(self, expenses_is_cash):
+        """
+        :param expenses_is_cash: list of (Expense, is_cash) tuples.
+        """
+        now = time.time()
+        self.connection.executemany(
+            """
+            INSERT OR REPLACE INTO comment_cache (
+                user_id, expense_id, updated_at, comments_count, is_cash,
+                cached_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (self.user_id, expense.getId(), expense.getUpdatedAt(),
+                 expense.getCommentsCount(), is_cash, now)
+                for expense, is_cash in expenses_is_cash
+            ]
+        )
+        self.connection.commit()
+
+    def evict(self, max_entries, max_age_days):
+        """
+        Removes the entries older than max_age_days and, if there are still
+        more than max_entries, the oldest ones.
+        """
+        self.connection.execute(
+            "DELETE FROM comment_cache WHERE cached_at < ?",
+            (time.time() - max_age_days * 24 * 3600, )
+        )
+        self.connection.execute(
+            """
+            DELETE FROM comment_cache WHERE rowid NOT IN (
+                SELECT rowid FROM comment_cache
+                ORDER BY cached_at DESC LIMIT ?
+            )
+            """,
+            (max_entries, )
+        )
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute("DELETE FROM comment_cache")
+        self.connection.commit()
+
+
+class SessionCache:
+    """
+    What Splitwise says about the session, like the current user or the
+    category catalogue, which hardly ever changes, so it isn't requested in
+    every run.
+
+    Entries belong to the token they were retrieved with (only its hash is
+    stored) and expire after ttl seconds. The ones of other tokens are
+    removed.
+    """
+    def __init__(self, connection, token, ttl):
+        self.connection = connection
+        self.token_hash = hashlib.sha256(
+            json.dumps(token, sort_keys=True).encode()
+        ).hexdigest()
+        self.ttl = ttl
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS session_cache (
+                token_hash TEXT,
+                key TEXT,
+                value TEXT,
+                cached_at REAL,
+                PRIMARY KEY (token_hash, key)
+            )
+        """)
+        self.connection.execute(
+            "DELETE FROM session_cache WHERE token_hash != ?",
+            (self.token_hash, )
+        )
+        self.connection.commit()
+
+    def get(self, key):
+        """
+        :return: the cached value, or None if it isn't cached or expired.
+        """
+        cursor = self.connection.execute(
+            """
+            SELECT value FROM session_cache
+            WHERE token_hash = ? AND key = ? AND cached_at >= ?
+            """,
+            (self.token_hash, key, time.time() - self.ttl)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        self.connection.execute(
+            """
+            INSERT OR REPLACE INTO session_cache (
+                token_hash, key, value, cached_at
+            )
+            VALUES (?, ?, ?, ?)
+            """,
+            (self.token_hash, key, json.dumps(value), time.time())
+        )
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute(
+            "DELETE FROM session_cache WHERE token_hash = ?",
+            (self.token_hash, )
+        )
+        self.connection.commit()
+
+
+class MirroredUser:
+    """
+    Stand-in for splitwise's User/ExpenseUser built from a mirrored payload.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def getId(self):
+        return self.data['id']
+
+    def getPaidShare(self):
+        return self.data['paid_share']
+
+    def getOwedShare(self):
+        return self.data['owed_share']
+
+
+class MirroredCategory:
+    def __init__(self, data):
+        self.data = data
+
+    def getId(self):
+        return self.data['id']
+
+    def getName(self):
+        return self.data['name']
+
+
+class MirroredExpense:
+    """
+    Stand-in for splitwise's Expense built from a mirrored payload, with the
+    getters that the synchronization uses.
+    https://splitwise.readthedocs.io/en/stable/api.html#splitwise.expense.Expense  #noqa
+    """
+    def __init__(self, data):
+        self.data = data
+        # Whether the current user commented it with the cash keyword, None
+        # if the comments weren't looked at.
+        self.cash_comment = data.get('cash_comment')
+
+    @staticmethod
+    def payload(expense, cash_comment=None):
+        """
+        :param expense: splitwise's Expense
+        :return: dict with everything that the synchronization needs from it.
+        """
+        category = expense.getCategory()
+        return {
+            'id': expense.getId(),
+            'description': expense.getDescription(),
+            'date': expense.getDate(),
+            'cost': expense.getCost(),
+            'payment': expense.getPayment(),
+            'creation_method': expense.getCreationMethod(),
+            'details': expense.getDetails(),
+            'comments_count': expense.getCommentsCount(),
+            'updated_at': expense.getUpdatedAt(),
+            'deleted_at': expense.getDeletedAt(),
+            'category': {
+                'id': category.getId(),
+                'name': category.getName(),
+            },
+            'users': [
+                {
+                    'id': user.getId(),
+                    'paid_share': user.getPaidShare(),
+                    'owed_share': user.getOwedShare(),
+                }
+                for user in expense.getUsers()
+            ],
+            'cash_comment': cash_comment,
+        }
+
+    def getId(self):
+        return self.data['id']
+
+    def getDescription(self):
+        return self.data['description']
+
+    def getDate(self):
+        return self.data['date']
+
+    def getCost(self):
+        return self.data['cost']
+
+    def getPayment(self):
+        return self.data['payment']
+
+    def getCreationMethod(self):
+        return self.data['creation_method']
+
+    def getDetails(self):
+        return self.data['details']
+
+    def getCommentsCount(self):
+        return self.data['comments_count']
+
+    def getUpdatedAt(self):
+        return self.data['updated_at']
+
+    def getDeletedAt(self):
+        return self.data['deleted_at']
+
+    def getCategory(self):
+        return MirroredCategory(self.data['category'])
+
+    def getUsers(self):
+        return [MirroredUser(user) for user in self.data['users']]
+
+
+class ExpenseMirror:
+    """
+    Copy of the Splitwise expenses as they were last retrieved, so the
+    synchronization can run again (--offline) without the API.
+    """
+    def __init__(self, connection, user_id):
+        self.connection = connection
+        self.user_id = user_id
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS expense_mirror (
+                user_id INTEGER,
+                expense_id INTEGER,
+                date TEXT,
+                updated_at TEXT,
+                payload TEXT,
+                PRIMARY KEY (user_id, expense_id)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS mirror_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO mirror_meta (key, value) VALUES (?, ?)",
+            ('last_user_id', str(user_id))
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def get_last_user_id(connection):
+        """
+        :return: id of the user whose expenses were mirrored the last time,
+        or None if nothing was ever mirrored.
+        """
+        try:
+            cursor = connection.execute(
+                "SELECT value FROM mirror_meta WHERE key = 'last_user_id'"
+            )
+        except sqlite3.OperationalError:
+            return None
+        row = cursor.fetchone()
+        return int(row[0]) if row else None
+
+    def save_many(self, payloads):
+        self.connection.executemany(
+            """
+            INSERT OR REPLACE INTO expense_mirror (
+                user_id, expense_id, date, updated_at, payload
+            )
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [
+                (self.user_id, payload['id'], payload['date'],
+                 payload['updated_at'], json.dumps(payload))
+                for payload in payloads
+            ]
+        )
+        self.connection.commit()
+
+    def iter_expenses(self, dated_after=None):
+        """
+        :param dated_after: Splitwise formatted date, only the expenses dated
+        after it are returned.
+        :return: generator of MirroredExpense, newest first like the API.
+        """
+        cursor = self.connection.execute(
+            """
+            SELECT payload FROM expense_mirror
+            WHERE user_id = ? AND date > ?
+            ORDER BY date DESC, expense_id DESC
+            """,
+            (self.user_id, dated_after or '')
+        )
+        for row in cursor:
+            yield MirroredExpense(json.loads(row[0]))
+
+
+class FingerprintStore:
+    """
+    Fingerprint of every synchronized expense (see
+    SplitwiseToBucketsSynch.get_fingerprint) with the ids of the
+    account_transaction rows that it ended up with in the budget file.
+
+    New fingerprints are staged and only saved with flush(), once the rows
+    they refer to have been committed in the budget.
+    """
+    def __init__(self, connection, budget):
+        self.connection = connection
+        self.budget = budget
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS expense_fingerprint (
+                budget TEXT,
+                expense_id INTEGER,
+                fingerprint TEXT,
+                transaction_ids TEXT,
+                PRIMARY KEY (budget, expense_id)
+            )
+        """)
+        self.connection.commit()
+        cursor = self.connection.execute(
+            """
+            SELECT expense_id, fingerprint, transaction_ids
+            FROM expense_fingerprint WHERE budget = ?
+            """,
+            (self.budget, )
+        )
+        self.fingerprints = {
+            expense_id: (fingerprint, json.loads(transaction_ids))
+            for expense_id, fingerprint, transaction_ids in cursor
+        }
+        self.staged = []
+
+    def get(self, expense_id):
+        """
+        :return: (fingerprint, transaction_ids) or (None, None)
+        """
+        return self.fingerprints.get(expense_id, (None, None))
+
+    def stage(self, expense_id, fingerprint, transaction_ids):
+        self.staged.append((expense_id, fingerprint, transaction_ids))
+
+    def map_staged_ids(self, function):
+        """
+        Replaces every staged transaction id by what function returns for
+        it.
+        """
+        self.staged = [
+            (expense_id, fingerprint, [function(i) for i in transaction_ids])
+            for expense_id, fingerprint, transaction_ids in self.staged
+        ]
+
+    def discard_staged(self):
+        self.staged = []
+
+    def flush(self):
+        self.connection.executemany(
+            """
+            INSERT OR REPLACE INTO expense_fingerprint (
+                budget, expense_id, fingerprint, transaction_ids
+            )
+            VALUES (?, ?, ?, ?)
+            """,
+            [
+                (self.budget, expense_id, fingerprint,
+                 json.dumps(transaction_ids))
+                for expense_id, fingerprint, transaction_ids in self.staged
+            ]
+        )
+        self.connection.commit()
+        for expense_id, fingerprint, transaction_ids in self.staged:
+            self.fingerprints[expense_id] = (fingerprint, transaction_ids)
+        self.staged = []
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# In the order they happen.
+PHASES = (
+    'auth',
+    'fetch',
+    'comments',
+    'transform',
+    'buckets_reads',
+    'buckets_writes',
+    'report',
+)
+
+PROMETHEUS_PREFIX = 'splitwise_buckets'
+
+
+class PhaseMetrics:
+    def __init__(self):
+        self.seconds = 0.0
+        self.http_requests = 0
+        # {kind: count}, kind being the first keyword of the statement.
+        self.statements = Counter()
+        # Rows read by the SELECTs or written by the rest.
+        self.rows = 0
+
+
+class Metrics:
+    """
+    Wall time, HTTP requests, SQL statements and rows of each phase of a
+    synchronization (see PHASES), to export them with write_json or
+    write_prometheus once it's finished.
+
+    Phases can be nested, like the comments retrieved while transforming an
+    expense, and the time of the inner one isn't counted in the outer one, so
+    the seconds of the phases of a thread never add up to more than the
+    whole run. With PipelinedSync the phases run at the same time in
+    different threads, so all together they can.
+    """
+    def __init__(self):
+        self.phases = {phase: PhaseMetrics() for phase in PHASES}
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        # Numbers of the whole run, like the expenses or the errors.
+        self.totals = {}
+        # Times that the budget file was locked by someone else, and seconds
+        # spent waiting for it.
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def phase(self, name):
+        if not hasattr(self.local, 'nested'):
+            self.local.nested = []
+        # Seconds spent in the phases nested in this one.
+        self.local.nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.local.nested.pop()
+            if self.local.nested:
+                self.local.nested[-1] += elapsed
+            with self.lock:
+                self.phases[name].seconds += elapsed - nested
+
+    def count_request(self, phase):
+        with self.lock:
+            self.phases[phase].http_requests += 1
+
+    def count_statement(self, phase, kind, rows=0):
+        with self.lock:
+            self.phases[phase].statements[kind] += 1
+            self.phases[phase].rows += max(rows, 0)
+
+    def count_lock_wait(self, seconds):
+        with self.lock:
+            self.lock_waits += 1
+            self.lock_wait_seconds += seconds
+
+    def as_dict(self):
+        return {
+            'started_at': self.started_at.isoformat(),
+            'seconds': time.perf_counter() - self.start,
+            'lock_waits': self.lock_waits,
+            'lock_wait_seconds': self.lock_wait_seconds,
+            **self.totals,
+            'phases': {
+                name: {
+                    'seconds': phase.seconds,
+                    'http_requests': phase.http_requests,
+                    'statements': dict(phase.statements),
+                    'rows': phase.rows,
+                }
+                for name, phase in self.phases.items()
+            },
+        }
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.as_dict(), indent=2))
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics in Prometheus' text format, for node_exporter's
+        textfile collector.
+        """
+        data = self.as_dict()
+        lines = []
+
+        def add(name, description, samples):
+            name = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                labels = ','.join(
+                    f'{key}="{label}"' for key, label in labels.items()
+                )
+                lines.append(
+                    f"{name}{{{labels}}} {value}" if labels
+                    else f"{name} {value}"
+                )
+
+        add('last_run_timestamp_seconds',
+            "When the last synchronization started.",
+            [({}, self.started_at.timestamp())])
+        add('duration_seconds', "Wall time of the last synchronization.",
+            [({}, data['seconds'])])
+        add('lock_waits', "Times that the budget file was locked.",
+            [({}, data['lock_waits'])])
+        add('lock_wait_seconds', "Seconds spent waiting for the budget file "
+            "to be unlocked.", [({}, data['lock_wait_seconds'])])
+        for key, value in self.totals.items():
+            add(key, f"{key.capitalize()} of the last synchronization.",
+                [({}, value)])
+        phases = data['phases']
+        add('phase_seconds', "Wall time of each phase.",
+            [({'phase': name}, phase['seconds'])
+             for name, phase in phases.items()])
+        add('phase_http_requests', "Requests made to Splitwise in each phase.",
+            [({'phase': name}, phase['http_requests'])
+             for name, phase in phases.items()])
+        add('phase_statements',
+            "SQL statements run on the budget file in each phase, by kind.",
+            [({'phase': name, 'kind': kind}, count)
+             for name, phase in phases.items()
+             for kind, count in sorted(phase['statements'].items())])
+        add('phase_rows', "Rows read or written in each phase.",
+            [({'phase': name}, phase['rows'])
+             for name, phase in phases.items()])
+        write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def statement_kind(statement):
+    """
+    :return: first keyword of the SQL statement, like SELECT or INSERT.
+    """
+    return statement.split(None, 1)[0].upper()
+
+
+def write_atomically(path, content):
+    # Like SyncState.save, so whatever reads the file never sees it half
+    # written.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as metrics_file:
+        metrics_file.write(content)
+    os.replace(tmp_path, path)
@@ -0,0 +1,31 @@
+"""
+Amounts are integer cents everywhere, the same as Buckets stores them. They
+are parsed once from the strings that Splitwise sends and only turned back
+into strings to show them.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+
+def parse_cents(amount):
+    """
+    parse_cents('12.3') == 1230
+
+    :param amount: Splitwise amount, a string with up to 2 decimals.
+    """
+    amount = str(amount).strip()
+    sign = -1 if amount.startswith('-') else 1
+    units, _, fraction = amount.lstrip('+-').partition('.')
+    if len(fraction) > 2 or not (units + fraction).isdigit():
+        # Not the usual format, letting Decimal deal with it.
+        cents = Decimal(amount) * 100
+        return int(cents.to_integral_value(ROUND_HALF_UP))
+    return sign * (int(units or 0) * 100 + int(fraction.ljust(2, '0')))
+
+
+def format_cents(cents):
+    """
+    format_cents(-1230) == '-12.30'
+    """
+    sign = '-' if cents < 0 else ''
+    units, fraction = divmod(abs(cents), 100)
+    return f"{sign}{units}.{fraction:02d}"
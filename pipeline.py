@@ -0,0 +1,107 @@
+"""
+Runs the synchronization as three stages, each in its own thread, connected
+by bounded queues:
+
+    fetch (pages and their comments) -> transform -> write (budget file)
+
+so Splitwise is being asked for the next pages while the previous ones are
+written in the budget file, and a run takes about as long as the slowest of
+them instead of all of them added up.
+
+The writer is the thread that calls run(), the one that owns the budget
+file's connection, so there's only ever one thread writing to it. When a
+queue is full the stage before it waits, so no more than queue_size items
+are ever waiting between two stages.
+"""
+import queue
+import threading
+
+# Put in a queue by the stage feeding it when it's done, with the exception
+# that stopped it if any.
+DONE = object()
+
+# How often, in seconds, a stage waiting on a queue checks if it should stop.
+POLL_INTERVAL = 0.1
+
+
+class Pipeline:
+    def __init__(self, source, transform, write, queue_size=2):
+        """
+        :param source: iterable of items, like pages of expenses, iterated in
+        the fetch thread.
+        :param transform: function run in the transform thread for every
+        item, its result is what's written.
+        :param write: function run in the calling thread for every
+        transformed item.
+        """
+        self.source = source
+        self.transform = transform
+        self.write = write
+        self.queue_size = queue_size
+        # Set when the writer stops, whether it finished or not, so the other
+        # stages don't keep working (or waiting) for nothing.
+        self.stopping = threading.Event()
+
+    def put(self, output, item, error=None):
+        while not self.stopping.is_set():
+            try:
+                output.put((item, error), timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def drain(self, input):
+        """
+        :return: generator of the items put in the queue until the stage
+        feeding it is done. If it failed, its exception is raised.
+        """
+        while not self.stopping.is_set():
+            try:
+                item, error = input.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item is DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+
+    def feed(self, items, output):
+        """
+        Puts every item in the output queue and then DONE, with the exception
+        if getting them failed.
+        """
+        try:
+            for item in items:
+                self.put(output, item)
+                if self.stopping.is_set():
+                    return
+        except BaseException as e:
+            self.put(output, DONE, e)
+        else:
+            self.put(output, DONE)
+
+    def run(self):
+        fetched = queue.Queue(self.queue_size)
+        transformed = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(
+                target=self.feed, args=(iter(self.source), fetched),
+                name='pipeline-fetch', daemon=True
+            ),
+            threading.Thread(
+                target=self.feed,
+                args=(map(self.transform, self.drain(fetched)), transformed),
+                name='pipeline-transform', daemon=True
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for item in self.drain(transformed):
+                self.write(item)
+        finally:
+            self.stopping.set()
+            # A stage in the middle of a request stops when it's answered.
+            for thread in threads:
+                thread.join()
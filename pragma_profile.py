@@ -0,0 +1,58 @@
+"""
+SQLite settings (pragmas) for the budget file's connection that make the
+synchronization faster, set while it runs and put back as they were when it
+finishes (see the Pragmas setting).
+"""
+import re
+
+# The only ones that can be set, all of them only affect the connection:
+# nothing is changed in the budget file itself.
+PRAGMAS = ('cache_size', 'mmap_size', 'temp_store', 'synchronous')
+
+# They end up in the statement as they are, so only numbers or keywords.
+VALUE = re.compile(r'^(-?\d+|[A-Za-z_]+)$')
+
+
+class UnsupportedPragma(Exception):
+    pass
+
+
+class PragmaProfile:
+    def __init__(self, connection, pragmas):
+        """
+        :param pragmas: {name: value}, like {'temp_store': 'memory'}.
+        """
+        self.connection = connection
+        self.pragmas = {}
+        for name, value in pragmas.items():
+            if isinstance(value, bool):
+                # YAML reads on/off as booleans.
+                value = int(value)
+            if name not in PRAGMAS:
+                raise UnsupportedPragma(
+                    f"'{name}' isn't one of the supported pragmas: "
+                    f"{', '.join(PRAGMAS)}."
+                )
+            if not VALUE.match(str(value)):
+                raise UnsupportedPragma(
+                    f"'{value}' isn't a valid value for the '{name}' pragma."
+                )
+            self.pragmas[name] = value
+        # What they were before apply().
+        self.original = {}
+
+    def get(self, name):
+        row = self.connection.execute(f"PRAGMA {name}").fetchone()
+        return row[0] if row else None
+
+    def apply(self):
+        for name, value in self.pragmas.items():
+            original = self.get(name)
+            if original is not None:
+                self.original[name] = original
+            self.connection.execute(f"PRAGMA {name} = {value}")
+
+    def restore(self):
+        for name, value in self.original.items():
+            self.connection.execute(f"PRAGMA {name} = {value}")
+        self.original = {}
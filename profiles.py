@@ -0,0 +1,189 @@
+"""
+Several synchronizations (e.g. one per household member, each with their own
+Splitwise token and budget file) in a single invocation, configured in the
+Profiles setting and run in parallel, one process per profile:
+
+    python synch.py --profiles
+"""
+import io
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import get_context
+
+from settings import config
+
+
+class UnknownProfile(Exception):
+    pass
+
+
+def suffixed(path, name):
+    """
+    suffixed('sync_state.json', 'alice') == 'sync_state.alice.json'
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+def get_profiles(names=None):
+    """
+    :param names: only these profiles, all of them if empty.
+    :return: the Profiles settings, in the same order.
+    """
+    profiles = config['Profiles'].get() or []
+    for profile in profiles:
+        if not profile.get('Name'):
+            raise UnknownProfile("Every profile in Profiles needs a Name.")
+    if not names:
+        return profiles
+    by_name = {profile['Name']: profile for profile in profiles}
+    missing = [name for name in names if name not in by_name]
+    if missing:
+        raise UnknownProfile(
+            f"There's no profile named {', '.join(missing)} in Profiles."
+        )
+    return [by_name[name] for name in names]
+
+
+def get_overrides(profile):
+    """
+    :return: the settings of the profile, to be set over the rest of
+    config.yaml. Unless the profile sets them, its LocalStorePath,
+    StateFilePath, ReportPath and SqlProfilePath get its name as a suffix so
+    every profile keeps its own state, caches and reports.
+    """
+    name = profile['Name']
+    overrides = {
+        key: value for key, value in profile.items() if key != 'Name'
+    }
+    overrides.setdefault(
+        'LocalStorePath', suffixed(config['LocalStorePath'].get(), name)
+    )
+    if config['ReportPath'].get():
+        overrides.setdefault(
+            'ReportPath', suffixed(config['ReportPath'].get(), name)
+        )
+    splitwise = dict(overrides.get('Splitwise') or {})
+    splitwise.setdefault(
+        'StateFilePath',
+        suffixed(config['Splitwise']['StateFilePath'].get(), name)
+    )
+    overrides['Splitwise'] = splitwise
+    if config['Buckets']['SqlProfilePath'].get():
+        buckets = dict(overrides.get('Buckets') or {})
+        buckets.setdefault(
+            'SqlProfilePath',
+            suffixed(config['Buckets']['SqlProfilePath'].get(), name)
+        )
+        overrides['Buckets'] = buckets
+    return overrides
+
+
+def sync_profile(name, overrides, synch_options, metrics_json=None,
+                 metrics_prom=None):
+    """
+    Runs in its own process. Whatever happens is caught and returned, so a
+    failing profile doesn't stop the others.
+
+    :return: dict with the profile's name, its output, how long it took, the
+    expenses and errors of the synchronization and, if it couldn't finish,
+    why.
+    """
+    config.set(overrides)
+    if synch_options.get('report_path'):
+        synch_options = dict(
+            synch_options,
+            report_path=suffixed(synch_options['report_path'], name)
+        )
+    result = {
+        'profile': name,
+        'seconds': None,
+        'expenses': None,
+        'errors': None,
+        'failure': None,
+        'output': None,
+    }
+    output = io.StringIO()
+    start = time.perf_counter()
+    with redirect_stdout(output), redirect_stderr(output):
+        try:
+            from synch import SplitwiseToBucketsSynch
+            synch = SplitwiseToBucketsSynch(**synch_options)
+            synch.run()
+            synch.bk.report_sql_profile()
+            synch.export_metrics(
+                metrics_json and suffixed(metrics_json, name),
+                metrics_prom and suffixed(metrics_prom, name)
+            )
+            result['expenses'] = synch.sw.expenses_count
+            result['errors'] = synch.errors
+        except SystemExit:
+            # The synchronization exits when it can't authenticate, after
+            # saying why.
+            result['failure'] = "Authentication failed"
+        except Exception as e:
+            traceback.print_exc()
+            result['failure'] = f"{type(e).__name__}: {e}"
+    result['seconds'] = time.perf_counter() - start
+    result['output'] = output.getvalue()
+    return result
+
+
+def sync_profiles(profiles, synch_options, metrics_json=None,
+                  metrics_prom=None):
+    """
+    Synchronizes the given profiles, ProfilesConcurrency at a time, and prints
+    the output of each of them followed by a summary.
+
+    :param synch_options: keyword arguments of SplitwiseToBucketsSynch. Its
+    report_path, if any, gets the name of every profile as a suffix.
+    :param metrics_json: like --metrics-json, the file of every profile gets
+    its name as a suffix. The same for metrics_prom.
+    :return: list of sync_profile results.
+    """
+    from tabulate import tabulate
+
+    # A new process for each profile, so they start with a clean
+    # configuration.
+    with ProcessPoolExecutor(
+            max_workers=config['ProfilesConcurrency'].get() or None,
+            mp_context=get_context('spawn')
+    ) as executor:
+        futures = [
+            executor.submit(
+                sync_profile, profile['Name'], get_overrides(profile),
+                synch_options, metrics_json, metrics_prom
+            )
+            for profile in profiles
+        ]
+        results = []
+        for profile, future in zip(profiles, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # The process itself died.
+                results.append({
+                    'profile': profile['Name'],
+                    'seconds': None,
+                    'expenses': None,
+                    'errors': None,
+                    'failure': f"{type(e).__name__}: {e}",
+                    'output': '',
+                })
+
+    for result in results:
+        print(f"\n👤 {result['profile']}")
+        print(result['output'])
+    print(tabulate(
+        [
+            (result['profile'], result['seconds'], result['expenses'],
+             result['errors'], result['failure'] or 'ok')
+            for result in results
+        ],
+        ['profile', 'seconds', 'expenses', 'errors', 'status'],
+        tablefmt="fancy_grid", floatfmt=".2f"
+    ))
+    return results
@@ -0,0 +1,118 @@
+"""
+Where the report of a synchronization goes, a line per expense (see
+synch.ReportLine).
+
+The grid is the classic table printed once everything is synchronized. The
+others write every line as soon as its expense is done, so big runs can be
+followed while they happen (e.g. with 'tail -f') and the report isn't kept in
+memory:
+
+    python synch.py --report-format jsonl --report-path report.jsonl
+"""
+import csv
+import json
+import sys
+
+
+class ReportSink:
+    def add(self, line):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class GridReportSink(ReportSink):
+    """
+    Keeps the lines and prints them as a table in close(), only for small
+    runs.
+    """
+    def __init__(self, columns, stream=None):
+        self.columns = columns
+        self.stream = stream or sys.stdout
+        self.lines = []
+
+    def add(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        from tabulate import tabulate
+
+        if self.lines:
+            print(
+                tabulate(
+                    (line.render() for line in self.lines), self.columns,
+                    tablefmt="fancy_grid"
+                ),
+                file=self.stream
+            )
+        self.lines = []
+
+
+class StreamingReportSink(ReportSink):
+    """
+    Writes every line right away to the given path, appending to it so
+    --watch runs keep the lines of the previous ones, or to the standard
+    output if there's no path. Every line also says its outcome (see
+    ReportLine.outcome).
+    """
+    def __init__(self, columns, path=None):
+        self.columns = list(columns) + ['outcome']
+        self.path = path
+        if path:
+            self.stream = open(path, 'a', newline='')
+        else:
+            self.stream = sys.stdout
+        self.start()
+
+    def start(self):
+        pass
+
+    def write(self, values):
+        raise NotImplementedError
+
+    def add(self, line):
+        self.write(
+            dict(zip(self.columns, line.values() + (line.outcome(), )))
+        )
+        self.stream.flush()
+
+    def close(self):
+        if self.path:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class JsonlReportSink(StreamingReportSink):
+    def write(self, values):
+        self.stream.write(json.dumps(values) + '\n')
+
+
+class CsvReportSink(StreamingReportSink):
+    def start(self):
+        self.writer = csv.DictWriter(self.stream, self.columns)
+        # The header only once, not again after every --watch run.
+        if not self.path or self.stream.tell() == 0:
+            self.writer.writeheader()
+
+    def write(self, values):
+        self.writer.writerow(values)
+
+
+REPORT_SINKS = {
+    'grid': GridReportSink,
+    'jsonl': JsonlReportSink,
+    'csv': CsvReportSink,
+}
+
+
+def open_report_sink(report_format, columns, path=None):
+    """
+    :param report_format: one of REPORT_SINKS.
+    :param path: file for the streaming formats, the standard output if
+    empty. The grid is always printed.
+    """
+    if report_format == 'grid':
+        return GridReportSink(columns)
+    return REPORT_SINKS[report_format](columns, path)
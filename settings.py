@@ -6,4 +6,5 @@ class MyConfiguration(confuse.Configuration):
         return './'
 
 
-config = MyConfiguration('SplitwiseToBuckets')
+# Its config_default.yaml has the settings missing from older config.yaml.
+config = MyConfiguration('SplitwiseToBuckets', __name__)
@@ -0,0 +1,95 @@
+"""
+How the amounts of a batch of expenses split into the payment (or cash)
+expense, the splitwise expense and the transfer between both accounts,
+computed for the whole batch at once on columns of integer cents. Both
+SplitwiseToBucketsSynch.get_batch_operations and get_expense_operations (for
+a single expense) get their amounts from here.
+
+The cases, for a 50€ expense:
+
+    I paid: 1€              I owe: 25€
+    Paid by other: 49€      Owed by other: 25€
+
+Means 1 expense is the 1€ from payments account, and another expense is 24€
+from splitwise account.
+
+    I paid: 0€              I owe: 25€
+    Paid by other: 50€      Owed by other: 25€
+
+There's only one expense of 25€ from splitwise account. Nonetheless we don't
+know if that's an expense already existing in Buckets (previously marked as
+I paid something) and now it's modified. To handle that situation the 0€
+expense is passed to BucketManager too, so it will detect that it's an update
+and set the existing payments account expense to 0€. Not super elegant to end
+up with a 0€ transaction in Buckets, but it's the most informative and less
+problematic option.
+
+    I paid: 25€             I owe: 25€
+    Paid by other: 25€      Owed by other: 25€
+
+Means only 1 expense of 25€ from payments account.
+
+    I paid: 49€             I owe: 25€
+    Paid by other: 1€       Owed by other: 25€
+
+Means one 25€ expense from payments account and a transfer from payments
+account to splitwise account for 24€. And if I owe nothing (I paid 13€ that
+the other owes), only the transfer of 13€; the payment expense is 0€ and
+nothing is done with it.
+
+All of it is:
+
+    payment expense = -min(i_paid, i_owe)
+    splitwise expense = -max(i_owe - i_paid, 0)
+    transfer to splitwise = max(i_paid - i_owe, 0)
+
+and, for payments, a transfer from splitwise of the total amount. Being
+integers, the payment and splitwise expenses always add up to i_owe and the
+transfer minus the payment expense to i_paid. tests/test_splits.py checks it
+against the cases above for lots of random expenses.
+"""
+from array import array
+
+
+class SplitColumns:
+    """
+    Amounts of a batch of expenses, one array of integer cents per field.
+    """
+    def __init__(self, exp_objs):
+        self.total_amount = array('q', [
+            exp_obj.total_amount for exp_obj in exp_objs
+        ])
+        self.i_paid = array('q', [exp_obj.i_paid for exp_obj in exp_objs])
+        self.i_owe = array('q', [exp_obj.i_owe for exp_obj in exp_objs])
+        self.is_payment = array('b', [
+            exp_obj.is_payment for exp_obj in exp_objs
+        ])
+
+
+def compute_splits(columns):
+    """
+    A single pass over the columns that fills the three results, which start
+    as zeros (already the amounts that payments don't have).
+
+    :param columns: SplitColumns
+    :return: (payment, splitwise, transfer) arrays of integer cents, with the
+    signs of the amounts that go to Buckets. For payments, transfer is the
+    transfer from splitwise and the other two are 0.
+    """
+    count = len(columns.i_paid)
+    payment = array('q', bytes(8 * count))
+    splitwise = array('q', bytes(8 * count))
+    transfer = array('q', bytes(8 * count))
+    for i, (total, paid, owe, is_payment) in enumerate(zip(
+            columns.total_amount, columns.i_paid, columns.i_owe,
+            columns.is_payment
+    )):
+        if is_payment:
+            transfer[i] = total
+            continue
+        # What I paid of my own share.
+        covered = paid if paid < owe else owe
+        payment[i] = -covered
+        splitwise[i] = covered - owe
+        transfer[i] = paid - covered
+    return payment, splitwise, transfer
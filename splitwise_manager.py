@@ -1,22 +1,112 @@
+import itertools
+import threading
+import time
 import webbrowser
-from datetime import datetime, timedelta
-from splitwise import Splitwise
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
+import local_store
+from local_store import (
+    CommentCache, ExpenseMirror, MirroredExpense, MirroredUser, SessionCache
+)
+from metrics import Metrics
+from money import parse_cents
 from settings import config
+from sync_state import SyncState
 
 config = config['Splitwise']
 
 
+class RateLimiter:
+    """
+    Spaces out the calls to wait() so, between all the threads, there are no
+    more than `rate` per second. A rate of 0 means no limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MissingExpenseMirror(Exception):
+    pass
+
+
+def get_http_status(exception):
+    # The client stores the status code of the response in a tuple.
+    status = exception.http_status
+    if isinstance(status, tuple):
+        status = status[0] if status else None
+    return status
+
+
+def get_retry_after(exception):
+    """
+    :return: seconds that the 429 response asked to wait, or None.
+    """
+    try:
+        return float(exception.http_headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
 class SplitWiseManager:
     authentication_state = None
     current_user = None
 
-    def __init__(self):
-        self.instance = Splitwise(
-            config['ConsumerKey'].get(),
-            config['ConsumerSecret'].get()
+    def __init__(self, offline=False, instance=None, metrics=None):
+        """
+        :param instance: object to talk to Splitwise with instead of the
+        splitwise.Splitwise client, like benchmarks.fake_splitwise's.
+        """
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Offline, the expenses come from the ExpenseMirror instead of the
+        # API.
+        self.offline = offline
+        # The client is only created when it's used, see instance.
+        self._instance = instance
+        self.sync_state = SyncState()
+        # Whether the last iter_expense_pages retrieved the whole window or only
+        # what was updated since the previous synchronization.
+        self.full_sync = True
+        self.expenses_count = 0
+        self.latest_update = None
+        # Whether the expenses of the current page have a cash comment, by
+        # expense id.
+        self.cash_comments = {}
+        self.comment_cache = None
+        self.session_cache = None
+        self.expense_mirror = None
+        self.local_store = None
+        self.comments_rate_limiter = RateLimiter(
+            config['CommentsRateLimit'].get()
         )
 
+    @property
+    def instance(self):
+        """
+        The splitwise.Splitwise client, created (and the SDK, with requests
+        and all, imported) the first time it's needed, so offline runs don't
+        pay for it.
+        """
+        if self._instance is None:
+            from splitwise import Splitwise
+            self._instance = Splitwise(
+                config['ConsumerKey'].get(),
+                config['ConsumerSecret'].get()
+            )
+        return self._instance
+
     def launch_authentication(self):
         url, state = self.instance.getOAuth2AuthorizeURL(
             config['CallbackUrl'].get()
@@ -34,12 +124,84 @@ class SplitWiseManager:
         if not access_token:
             access_token = config['LastValidToken'].get()
         self.instance.setOAuth2AccessToken(access_token)
-        self.current_user = self.get_current_user()
+        if config['SessionCache'].get():
+            self.session_cache = SessionCache(
+                self.get_local_store(), access_token,
+                config['SessionCacheTtlHours'].get() * 3600
+            )
+        with self.metrics.phase('auth'):
+            self.current_user = self.get_current_user()
 
     def get_current_user(self):
-        return self.instance.getCurrentUser()
+        """
+        With the SessionCache, the user is only requested when the cached one
+        expires, so a token that stops working is noticed in the first
+        request that it's used for instead (see call_api).
+        """
+        if self.session_cache is not None:
+            user = self.session_cache.get('current_user')
+            if user is not None:
+                return MirroredUser(user)
+        user = self.call_api('auth', self.instance.getCurrentUser)
+        if self.session_cache is not None:
+            self.session_cache.set('current_user', {'id': user.getId()})
+        return user
 
-    def get_expenses(self):
+    def call_api(self, phase, method, *args, **kwargs):
+        """
+        Calls the given method of the client, counting the request in the
+        given phase of the Metrics, and, when Splitwise answers that
+        there are too many requests, tries again up to ApiRetries times,
+        waiting what the response asks for or, if it doesn't, ApiBackoffSeconds
+        doubling every time.
+        """
+        from splitwise.exception import (
+            SplitwiseException, SplitwiseUnauthorizedException
+        )
+
+        retries = config['ApiRetries'].get()
+        backoff = config['ApiBackoffSeconds'].get()
+        for attempt in range(retries + 1):
+            self.metrics.count_request(phase)
+            try:
+                return method(*args, **kwargs)
+            except SplitwiseUnauthorizedException:
+                # Whatever was cached with this token can't be trusted.
+                if self.session_cache is not None:
+                    self.session_cache.clear()
+                raise
+            except SplitwiseException as e:
+                if get_http_status(e) != 429 or attempt == retries:
+                    raise
+                delay = get_retry_after(e)
+                if delay is None:
+                    delay = backoff * 2 ** attempt
+                time.sleep(delay)
+
+    def get_updated_after(self):
+        """
+        With IncrementalSync, only the expenses updated (or deleted) after the
+        last synchronized one are requested, unless it's been more than
+        FullSyncEveryDays since the last time that the whole window was
+        synchronized.
+
+        :return: Splitwise's updated_at of the last synchronized expense, or
+        None when the whole window has to be synchronized.
+        """
+        if not config['IncrementalSync'].get():
+            return None
+        updated_after = self.sync_state.get('updated_after')
+        last_full_sync = self.sync_state.get('last_full_sync')
+        if not updated_after or not last_full_sync:
+            return None
+        last_full_sync = datetime.fromisoformat(last_full_sync)
+        full_sync_every = timedelta(days=config['FullSyncEveryDays'].get())
+        if datetime.now(timezone.utc) - last_full_sync >= full_sync_every:
+            return None
+        return updated_after
+
+    @staticmethod
+    def get_dated_after():
         # Adding 1 because the API call filter skips the day itself
         days_ago = config['ExpensesDaysAgo'].get() + 1
         days_ago_date = datetime.now() - timedelta(days_ago)
@@ -48,38 +210,228 @@ class SplitWiseManager:
         dated_after = days_ago_date
         if days_ago_date < max_dated_after_py:
             dated_after = max_dated_after_py
+        return dated_after
 
-        expenses = self.instance.getExpenses(
-            dated_after=dated_after,
-            limit=config['ExpensesLimit'].get()
-            # updated_after = '2020-08-01'
-        )
+    def iter_expense_pages(self):
+        """
+        Goes through all the pages of expenses in the window, requesting the
+        next page only when the previous one has been consumed. From then on
+        and until forget_cash_comments, cash_comments has the cash comments
+        of its expenses.
+
+        :return: generator of lists of Expense objects
+        https://splitwise.readthedocs.io/en/stable/api.html#splitwise.expense.Expense  #noqa
+        """
+        self.cash_comments = {}
+        if self.offline:
+            yield from self.iter_mirrored_pages()
+            return
+
+        dated_after = self.get_dated_after()
+        updated_after = self.get_updated_after()
+        self.full_sync = updated_after is None
+        self.expenses_count = 0
+        page_size = config['ExpensesPageSize'].get()
+        offset = 0
+        while True:
+            # Deleted expenses are included too, with their deleted_at set.
+            with self.metrics.phase('fetch'):
+                expenses = self.call_api(
+                    'fetch',
+                    self.instance.getExpenses,
+                    dated_after=dated_after,
+                    updated_after=updated_after,
+                    offset=offset,
+                    limit=page_size
+                )
+            with self.metrics.phase('comments'):
+                self.prefetch_comments(expenses)
+            if self.expense_mirror is not None:
+                with self.metrics.phase('fetch'):
+                    self.expense_mirror.save_many([
+                        MirroredExpense.payload(
+                            expense, self.cash_comments.get(expense.getId())
+                        )
+                        for expense in expenses
+                    ])
+            self.expenses_count += len(expenses)
+            for expense in expenses:
+                if (
+                    self.latest_update is None
+                    or expense.getUpdatedAt() > self.latest_update
+                ):
+                    self.latest_update = expense.getUpdatedAt()
+            if expenses:
+                yield expenses
+            if len(expenses) < page_size:
+                break
+            offset += page_size
+
+    def iter_mirrored_pages(self):
+        """
+        Same than iter_expense_pages but from the ExpenseMirror, always the
+        whole window.
 
-        print(f"\n{len(expenses)} imported expenses from Splitwise\n")
-        if len(expenses) == config['ExpensesLimit'].get():
-            print(
-                "You might be hitting the SPLITWISE_EXPENSES_LIMIT, increase "
-                "it or reduce the SPLITWISE_EXPENSES_DAYS_AGO to make sure "
-                "you're importing all the expenses in your desired range.")
+        :return: generator of lists of MirroredExpense objects
+        """
+        dated_after = self.get_dated_after().strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.full_sync = True
+        self.expenses_count = 0
+        page_size = config['ExpensesPageSize'].get()
+        expenses = self.expense_mirror.iter_expenses(dated_after)
+        while True:
+            with self.metrics.phase('fetch'):
+                page = list(itertools.islice(expenses, page_size))
+            if not page:
+                break
+            self.expenses_count += len(page)
+            self.cash_comments.update(
+                (expense.getId(), expense.cash_comment)
+                for expense in page
+                if expense.cash_comment is not None
+            )
+            yield page
 
-        return expenses
+    def save_sync_state(self, advance=True):
+        """
+        :param advance: False to keep the previous watermark, for instance
+        when some expense failed, so it's requested again in the next run.
+        """
+        # It's only needed by IncrementalSync, no file otherwise.
+        if not config['IncrementalSync'].get():
+            return
+        now = datetime.now(timezone.utc).isoformat()
+        self.sync_state.set('last_run', now)
+        if advance:
+            previous = self.sync_state.get('updated_after')
+            if self.latest_update and (
+                    not previous or self.latest_update > previous):
+                self.sync_state.set('updated_after', self.latest_update)
+            if self.full_sync:
+                self.sync_state.set('last_full_sync', now)
+        self.sync_state.save()
 
     def get_expense_comments(self, expense_id):
-        return self.instance.getComments(expense_id)
+        self.comments_rate_limiter.wait()
+        return self.call_api(
+            'comments', self.instance.getComments, expense_id
+        )
+
+    def get_local_store(self):
+        if self.local_store is None:
+            # The caches and the mirror are used from the fetch thread of the
+            # Pipeline, one thread at a time.
+            self.local_store = local_store.connect(check_same_thread=False)
+        return self.local_store
+
+    def open_expense_mirror(self):
+        """
+        Starts saving the retrieved expenses in the ExpenseMirror or, offline,
+        reading them from it. Online it needs to be authenticated, offline the
+        user is the one whose expenses were mirrored the last time.
+        """
+        if self.offline:
+            user_id = ExpenseMirror.get_last_user_id(self.get_local_store())
+            if user_id is None:
+                raise MissingExpenseMirror(
+                    "There are no mirrored expenses to work offline with, "
+                    "run the synchronization online with MirrorExpenses "
+                    "enabled first."
+                )
+            self.current_user = MirroredUser({'id': user_id})
+        self.expense_mirror = ExpenseMirror(
+            self.get_local_store(), self.current_user.getId()
+        )
+
+    def open_comment_cache(self, clear=False):
+        """
+        Starts using the persistent CommentCache. Needs to be authenticated
+        because what's cached depends on the current user.
+        """
+        self.comment_cache = CommentCache(
+            self.get_local_store(), self.current_user.getId()
+        )
+        if clear:
+            self.comment_cache.clear()
+        self.comment_cache.evict(
+            config['CommentCacheMaxEntries'].get(),
+            config['CommentCacheMaxAgeDays'].get()
+        )
+
+    @staticmethod
+    def needs_comments(expense):
+        # Same conditions than is_cash for looking at the comments.
+        return (
+            expense.getDetails() != config['ExpensesCashKeyword'].get()
+            and expense.getCommentsCount() > 0
+        )
+
+    def prefetch_comments(self, expenses):
+        """
+        Works out if there's a cash comment in all the given expenses that
+        is_cash is going to need, first from the CommentCache and then
+        retrieving the comments of the rest, CommentsConcurrency at a time,
+        instead of one by one while synchronizing them.
+        """
+        to_fetch = []
+        for expense in expenses:
+            if not self.needs_comments(expense):
+                continue
+            cached = None
+            if self.comment_cache is not None:
+                cached = self.comment_cache.get(expense)
+            if cached is None:
+                to_fetch.append(expense)
+            else:
+                self.cash_comments[expense.getId()] = cached
+        if not to_fetch:
+            return
+
+        with ThreadPoolExecutor(
+                max_workers=config['CommentsConcurrency'].get()
+        ) as executor:
+            results = executor.map(
+                self.get_expense_comments,
+                [expense.getId() for expense in to_fetch]
+            )
+            fetched = [
+                (expense, self.has_cash_comment(comments))
+                for expense, comments in zip(to_fetch, results)
+            ]
+        for expense, is_cash in fetched:
+            self.cash_comments[expense.getId()] = is_cash
+        if self.comment_cache is not None:
+            self.comment_cache.set_many(fetched)
+
+    def forget_cash_comments(self, expenses):
+        """
+        Once the given expenses have been through is_cash, so cash_comments
+        doesn't keep growing with every page.
+        """
+        for expense in expenses:
+            self.cash_comments.pop(expense.getId(), None)
+
+    def has_cash_comment(self, comments):
+        for comment in comments:
+            user = comment.getCommentedUser()
+            content = comment.getContent()
+            if (
+                user.getId() == self.current_user.getId()
+                and content == config['ExpensesCashKeyword'].get()
+            ):
+                return True
+        return False
 
     def is_cash(self, expense):
         if expense.getDetails() == config['ExpensesCashKeyword'].get():
             return True
         if expense.getCommentsCount() > 0:
-            comments = self.get_expense_comments(expense.getId())
-            for comment in comments:
-                user = comment.getCommentedUser()
-                content = comment.getContent()
-                if (
-                    user.getId() == self.current_user.getId()
-                    and content == config['ExpensesCashKeyword'].get()
-                ):
-                    return True
+            if expense.getId() in self.cash_comments:
+                return self.cash_comments[expense.getId()]
+            with self.metrics.phase('comments'):
+                return self.has_cash_comment(
+                    self.get_expense_comments(expense.getId())
+                )
         return False
 
     def get_my_expense_user_obj(self, expense):
@@ -101,20 +453,55 @@ class SplitWiseManager:
         of each involved user in the expense.
 
         :param expense: Expense object
-        :return: Sum of the amounts owed by others
+        :return: Sum of the amounts owed by others, in cents
         https://splitwise.readthedocs.io/en/stable/api.html#splitwise.user.ExpenseUser  #noqa
         """
-        total = 0.0
+        total = 0
         users = expense.getUsers()
         for expense_user_obj in users:
             if expense_user_obj.getId() != self.current_user.getId():
-                total += float(expense_user_obj.getOwedShare())
+                total += parse_cents(expense_user_obj.getOwedShare())
         return total
 
-    def print_categories_dict(self):
-        categories = self.instance.getCategories()
-        for category in categories:
-            print(f"{category.getId()}: '',  # {category.getName()}")
-            for subcategory in category.subcategories:
-                print(f"{subcategory.getId()}: '',"
-                      f"  # {subcategory.getName()}")
+    def get_categories(self, refresh=False):
+        """
+        :param refresh: request them even if they're in the SessionCache.
+        :return: list of the Splitwise categories as {'id', 'name',
+        'subcategories'} dicts, the subcategories with only id and name.
+        """
+        if self.session_cache is not None and not refresh:
+            categories = self.session_cache.get('categories')
+            if categories is not None:
+                return categories
+        categories = [
+            {
+                'id': category.getId(),
+                'name': category.getName(),
+                'subcategories': [
+                    {'id': subcategory.getId(), 'name': subcategory.getName()}
+                    for subcategory in category.subcategories
+                ],
+            }
+            for category in self.call_api(
+                'fetch', self.instance.getCategories
+            )
+        ]
+        if self.session_cache is not None:
+            self.session_cache.set('categories', categories)
+        return categories
+
+    def get_cached_categories(self):
+        """
+        :return: the categories as get_categories returns them if they're in
+        the SessionCache, None otherwise. Nothing is requested.
+        """
+        if self.session_cache is None:
+            return None
+        return self.session_cache.get('categories')
+
+    def print_categories_dict(self, refresh=False):
+        for category in self.get_categories(refresh):
+            print(f"{category['id']}: '',  # {category['name']}")
+            for subcategory in category['subcategories']:
+                print(f"{subcategory['id']}: '',"
+                      f"  # {subcategory['name']}")
@@ -0,0 +1,101 @@
+import csv
+import re
+import textwrap
+from contextlib import contextmanager
+
+
+# String and number literals, so statements that only differ in them (like
+# the ones built with f-strings) end up in the same template.
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# IN lists of any length.
+IN_LISTS = re.compile(r"\bIN \(\?(?:, ?\?)*\)", re.IGNORECASE)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class TemplateStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+
+class SqlProfiler:
+    """
+    Aggregates the statements run on the budget file by template: how many
+    times each one ran, how long it took in total and how many rows it read or
+    wrote.
+
+    budget() makes sure that a block of code doesn't run more than a given
+    number of statements, e.g. to catch a handle_expense that starts querying
+    the budget file once per transaction.
+    """
+    def __init__(self):
+        # {template: TemplateStats}
+        self.templates = {}
+        self.statements = 0
+
+    @staticmethod
+    def normalize(statement):
+        statement = ' '.join(statement.split())
+        statement = LITERALS.sub('?', statement)
+        return IN_LISTS.sub('IN (...)', statement)
+
+    def record(self, statement, seconds, rows=0):
+        template = self.normalize(statement)
+        stats = self.templates.get(template)
+        if stats is None:
+            stats = self.templates[template] = TemplateStats()
+        stats.count += 1
+        stats.seconds += seconds
+        stats.rows += max(rows, 0)
+        self.statements += 1
+
+    @contextmanager
+    def budget(self, max_statements, label='block'):
+        """
+        Raises QueryBudgetExceeded if the code inside runs more than
+        max_statements.
+        """
+        start = self.statements
+        yield
+        statements = self.statements - start
+        if statements > max_statements:
+            raise QueryBudgetExceeded(
+                f"The {label} ran {statements} SQL statements, more than "
+                f"the {max_statements} allowed."
+            )
+
+    def summary(self):
+        """
+        :return: list of (template, count, seconds, rows) tuples, the slowest
+        first.
+        """
+        return sorted(
+            (
+                (template, stats.count, stats.seconds, stats.rows)
+                for template, stats in self.templates.items()
+            ),
+            key=lambda row: row[2],
+            reverse=True
+        )
+
+    def print_summary(self):
+        from tabulate import tabulate
+
+        print(tabulate(
+            [
+                (textwrap.fill(template, 80), count, seconds * 1000, rows)
+                for template, count, seconds, rows in self.summary()
+            ],
+            ['statement', 'count', 'total ms', 'rows'],
+            tablefmt="fancy_grid", floatfmt=".2f"
+        ))
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as profile_file:
+            writer = csv.writer(profile_file)
+            writer.writerow(['statement', 'count', 'seconds', 'rows'])
+            writer.writerows(self.summary())
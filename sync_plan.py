@@ -0,0 +1,140 @@
+class SyncPlan:
+    """
+    The writes that a synchronization would do in the Buckets file, collected
+    by BucketManager when it's in plan mode instead of being executed.
+
+    Rows are stored in the same order as the parameters of the statements in
+    BucketManager.apply_plan, so they can be sent as they are to
+    executemany.
+
+    The account_transaction ids are assigned here (following the highest id in
+    the file) because the bucket transactions need to reference them before
+    anything is inserted. If the file gets new rows in the meantime (e.g.
+    Buckets is open), they're moved after them with shift_transaction_ids.
+    """
+    def __init__(self, last_transaction_id):
+        # The planned ids are the ones after it (and the offset).
+        self.first_transaction_id = last_transaction_id
+        self.last_transaction_id = last_transaction_id
+        # What shift_transaction_ids moved them.
+        self.transaction_id_offset = 0
+        # (id, posted, account_id, amount, memo, fi_id, general_cat)
+        self.transaction_inserts = []
+        # (posted, account_id, amount, memo, general_cat, id)
+        self.transaction_updates = []
+        # (posted, bucket_id, amount, memo, account_trans_id)
+        self.bucket_inserts = []
+        # (posted, amount, memo, account_trans_id)
+        self.bucket_updates = []
+        # (posted, bucket_id, amount, memo, account_trans_id)
+        self.bucket_recategorizations = []
+        # (fi_id, )
+        self.deletes = []
+        self.deleted_transactions = 0
+        self.deleted_bucket_transactions = 0
+        self.unchanged_transactions = 0
+        self.unchanged_bucket_transactions = 0
+        # {fi_id: (account_transaction rows, bucket_transaction rows)} that
+        # BucketManager.apply_plan removed.
+        self.removed_rows = {}
+
+    def next_transaction_id(self):
+        self.last_transaction_id += 1
+        return self.last_transaction_id
+
+    def get_applied_id(self, trans_id):
+        """
+        :return: the id that the given transaction has in the file once the
+        plan is applied, different from the planned one if it was shifted.
+        """
+        if trans_id > self.first_transaction_id:
+            return trans_id + self.transaction_id_offset
+        return trans_id
+
+    def shift_transaction_ids(self, offset):
+        """
+        Moves the planned ids, and the references to them, offset places.
+        """
+        # Where the planned ids start now.
+        after = self.first_transaction_id + self.transaction_id_offset
+
+        def shift(trans_id):
+            if trans_id > after:
+                return trans_id + offset
+            return trans_id
+
+        self.transaction_inserts = [
+            (shift(row[0]), ) + row[1:] for row in self.transaction_inserts
+        ]
+        for rows in ('transaction_updates', 'bucket_inserts', 'bucket_updates',
+                     'bucket_recategorizations'):
+            setattr(self, rows, [
+                row[:-1] + (shift(row[-1]), ) for row in getattr(self, rows)
+            ])
+        self.transaction_id_offset += offset
+        self.last_transaction_id += offset
+
+    def mark(self):
+        """
+        Returns the current size of the plan, to be able to drop what's added
+        after it with rollback_to.
+        """
+        return (
+            self.last_transaction_id,
+            len(self.transaction_inserts),
+            len(self.transaction_updates),
+            len(self.bucket_inserts),
+            len(self.bucket_updates),
+            len(self.bucket_recategorizations),
+            len(self.deletes),
+            self.deleted_transactions,
+            self.deleted_bucket_transactions,
+            self.unchanged_transactions,
+            self.unchanged_bucket_transactions,
+        )
+
+    def rollback_to(self, mark):
+        (
+            self.last_transaction_id,
+            transaction_inserts,
+            transaction_updates,
+            bucket_inserts,
+            bucket_updates,
+            bucket_recategorizations,
+            deletes,
+            self.deleted_transactions,
+            self.deleted_bucket_transactions,
+            self.unchanged_transactions,
+            self.unchanged_bucket_transactions,
+        ) = mark
+        del self.transaction_inserts[transaction_inserts:]
+        del self.transaction_updates[transaction_updates:]
+        del self.bucket_inserts[bucket_inserts:]
+        del self.bucket_updates[bucket_updates:]
+        del self.bucket_recategorizations[bucket_recategorizations:]
+        del self.deletes[deletes:]
+
+    def counts(self):
+        """
+        :return: list of (table, operation, count) tuples.
+        """
+        return [
+            ('account_transaction', 'insert', len(self.transaction_inserts)),
+            ('account_transaction', 'update', len(self.transaction_updates)),
+            ('account_transaction', 'delete', self.deleted_transactions),
+            ('account_transaction', 'unchanged',
+             self.unchanged_transactions),
+            ('bucket_transaction', 'insert', len(self.bucket_inserts)),
+            ('bucket_transaction', 'update',
+             len(self.bucket_updates) + len(self.bucket_recategorizations)),
+            ('bucket_transaction', 'delete',
+             self.deleted_bucket_transactions),
+            ('bucket_transaction', 'unchanged',
+             self.unchanged_bucket_transactions),
+        ]
+
+    def is_empty(self):
+        return not any(
+            count for table, operation, count in self.counts()
+            if operation != 'unchanged'
+        )
@@ -0,0 +1,37 @@
+import json
+import os
+
+from settings import config
+
+
+class SyncState:
+    """
+    Small JSON file, next to config.yaml, where the synchronization keeps what
+    it needs to remember between runs, like the last Splitwise update that
+    was synchronized.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(
+                config.config_dir(),
+                config['Splitwise']['StateFilePath'].get()
+            )
+        self.path = path
+        self.data = {}
+        if os.path.exists(self.path):
+            with open(self.path) as state_file:
+                self.data = json.load(state_file)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def save(self):
+        # Writing to a temporary file first so an interrupted run never leaves
+        # a half written state behind.
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.data, state_file, indent=2)
+        os.replace(tmp_path, self.path)
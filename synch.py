@@ -1,61 +1,173 @@
+import argparse
+import hashlib
 import sys
 import textwrap
 import traceback
-from decimal import Decimal
+from collections import Counter
 from datetime import datetime, timezone
 from dataclasses import dataclass, astuple
 
-from tabulate import tabulate
-from yaspin import yaspin
-from yaspin.spinners import Spinners
-from tqdm import tqdm
-
+import local_store
 from settings import config
 from buckets_manager import BucketManager
+from metrics import Metrics
+from pipeline import Pipeline
+from report_sinks import REPORT_SINKS, open_report_sink
+from money import format_cents, parse_cents
+from splits import SplitColumns, compute_splits
 from splitwise_manager import SplitWiseManager
-from splitwise.exception import SplitwiseUnauthorizedException
+
+
+# Change it whenever the way expenses are synchronized changes, so all of them
+# are synchronized again instead of being skipped as unchanged.
+FINGERPRINT_VERSION = 2
+
+INVALID_TOKEN = (
+    "Your token is not valid. Please run 'python authenticate.py' to start "
+    "the token generation process and follow the instructions. Remember that "
+    "you first need to create 'an app' in Splitwise, as it's explained in "
+    "README.md."
+)
 
 
 @dataclass
 class ReportLine:
-    name: str = ''
-    date: str = ''
-    total_amount: Decimal = 0.0
-    i_paid: Decimal = 0.0
-    i_owe: Decimal = 0.0
-    bucket_name: str = ''
-    debug: str = ''
+    """
+    A row of the report, with the values of the expense as they are. They are
+    only turned into text, and wrapped to fit, when the row is printed.
+    """
+    __slots__ = (
+        'name', 'date', 'total_amount', 'i_paid', 'i_owe', 'bucket_name',
+        'debug',
+    )
+    name: str
+    date: str
+    # Amounts in integer cents.
+    total_amount: int
+    i_paid: int
+    i_owe: int
+    bucket_name: str
+    debug: str
 
-    def __setattr__(self, key, value):
-        value = str(value)
-        value_lines = textwrap.wrap(value, 30)
-        value = "\n".join(value_lines)
-        super().__setattr__(key, value)
+    @classmethod
+    def from_expense(cls, exp_obj):
+        return cls(
+            exp_obj.name, exp_obj.date, exp_obj.total_amount, exp_obj.i_paid,
+            exp_obj.i_owe, exp_obj.bucket_name, ''
+        )
+
+    def outcome(self):
+        if self.debug in ('unchanged', 'deleted'):
+            return self.debug
+        return 'failed' if self.debug else 'synchronized'
+
+    def values(self):
+        return (
+            self.name,
+            str(self.date),
+            format_cents(self.total_amount),
+            format_cents(self.i_paid),
+            format_cents(self.i_owe),
+            self.bucket_name,
+            self.debug,
+        )
+
+    def render(self, width=30):
+        """
+        The values wrapped to fit in the grid.
+        """
+        return tuple(
+            "\n".join(textwrap.wrap(str(value), width))
+            for value in self.values()
+        )
 
 
 @dataclass
 class Expense:
+    __slots__ = (
+        'id', 'name', 'date', 'total_amount', 'i_paid', 'i_owe',
+        'bucket_name', 'bucket_id', 'owed_by_others', 'is_cash',
+        'is_payment', 'is_deleted',
+    )
+    # Amounts in integer cents.
     id: int
     name: str
     date: str
-    total_amount: Decimal
-    i_paid: Decimal
-    i_owe: Decimal
+    total_amount: int
+    i_paid: int
+    i_owe: int
     bucket_name: str
     bucket_id: int
-    owed_by_others: Decimal
+    owed_by_others: int
     is_cash: bool
     is_payment: bool
     is_deleted: bool
 
 
 class SplitwiseToBucketsSynch:
-    report = []
-    report_line = None
+    REPORT_MODES = ('full', 'summary')
+
+    def __init__(self, plan_only=False, comment_cache=True,
+                 clear_comment_cache=False, offline=False, splitwise=None,
+                 report_mode=None, report_format=None, report_path=None):
+        """
+        :param splitwise: object to talk to Splitwise with instead of the real
+        client, see benchmarks/fake_splitwise.py.
+        :param report_mode: 'full' or 'summary', the Report setting if None.
+        :param report_format: one of report_sinks.REPORT_SINKS, the
+        ReportFormat setting if None. The same for report_path and
+        ReportPath.
+        """
+        self.plan_only = plan_only
+        self.report_mode = report_mode or config['Report'].get()
+        if self.report_mode not in self.REPORT_MODES:
+            raise ValueError(
+                f"Report must be one of {', '.join(self.REPORT_MODES)}, not "
+                f"'{self.report_mode}'."
+            )
+        self.report_format = report_format or config['ReportFormat'].get()
+        self.report_path = report_path or config['ReportPath'].get()
+        if self.report_format not in REPORT_SINKS:
+            raise ValueError(
+                f"ReportFormat must be one of {', '.join(REPORT_SINKS)}, not "
+                f"'{self.report_format}'."
+            )
+        # Opened by run().
+        self.report_sink = None
+        self.report_outcomes = Counter()
+        self.report_line = None
+        self.errors = 0
+        # Expenses that weren't skipped as unchanged.
+        self.synchronized = 0
+        self.category_buckets = (
+            config['SplitwiseCategoriesToBucketNames'].get()
+        )
+        # Categories of the expenses that aren't in
+        # SplitwiseCategoriesToBucketNames, {id: name}.
+        self.unmapped_categories = {}
+        # Deleted expenses, {id: name}, and the rows they had in the budget
+        # file, {id: (account_transaction rows, bucket_transaction rows)}.
+        self.deleted_expenses = {}
+        self.removed_rows = {}
+        self.metrics = Metrics()
+        self.sw = SplitWiseManager(
+            offline=offline, instance=splitwise, metrics=self.metrics
+        )
+        self.bk = BucketManager(metrics=self.metrics)
+        self.fingerprints = None
+        if config['Buckets']['SkipUnchangedExpenses'].get():
+            self.fingerprints = local_store.FingerprintStore(
+                local_store.connect(),
+                config['Buckets']['BudgetFilePath'].get()
+            )
+        if offline:
+            self.sw.open_expense_mirror()
+            return
+
+        from splitwise.exception import SplitwiseUnauthorizedException
+        from yaspin import yaspin
+        from yaspin.spinners import Spinners
 
-    def __init__(self):
-        self.sw = SplitWiseManager()
-        self.bk = BucketManager()
         with yaspin(
                 Spinners.moon,
                 text="Authenticating into Splitwise API",
@@ -63,62 +175,178 @@ class SplitwiseToBucketsSynch:
         ) as spinner:
             try:
                 self.sw.authenticate()
-            except SplitwiseUnauthorizedException as e:
-                spinner.fail(
-                    "Authentication failed 😿 your token is not valid. Please "
-                    "run 'python authenticate.py' to start the token "
-                    "generation process and follow the instructions. Remember "
-                    "that you first need to create 'an app' in Splitwise, as "
-                    "it's explained in README.md."
-                )
+            except SplitwiseUnauthorizedException:
+                spinner.fail(f"Authentication failed 😿 {INVALID_TOKEN}")
                 sys.exit()
             except Exception as e:
                 spinner.fail(f"😿 Authentication failed with the error: {e}")
                 sys.exit()
             spinner.ok("Done! 😻")
+        self.print_unmapped_catalogue()
 
-        with yaspin(
-                Spinners.moon,
-                text="Retrieving Splitwise expenses",
-                color="blue"
-        ) as spinner:
-            self.sw.authenticate()
-            self.expenses = self.sw.get_expenses()
-            if not self.expenses or len(self.expenses) == 0:
-                spinner.fail("Couldn't retrieve the expenses 😿")
-                sys.exit()
-            spinner.ok("Done! 😻")
+        if clear_comment_cache or (
+                comment_cache and config['Splitwise']['CommentCache'].get()):
+            self.sw.open_comment_cache(clear=clear_comment_cache)
+            if not comment_cache:
+                self.sw.comment_cache = None
+        if config['Splitwise']['MirrorExpenses'].get():
+            self.sw.open_expense_mirror()
+
+    def reset(self):
+        """
+        Forgets the report, errors and metrics of the last run, to run it
+        again with everything else (connections, caches, etc.) still warm.
+        """
+        self.report_sink = None
+        self.report_outcomes = Counter()
+        self.report_line = None
+        self.errors = 0
+        self.synchronized = 0
+        self.unmapped_categories = {}
+        self.deleted_expenses = {}
+        self.removed_rows = {}
+        self.metrics = Metrics()
+        self.sw.metrics = self.metrics
+        self.bk.metrics = self.metrics
+
+    def close(self):
+        self.bk.connection.close()
+        if self.sw.local_store is not None:
+            self.sw.local_store.close()
+        if self.fingerprints is not None:
+            self.fingerprints.connection.close()
 
     def add_report_line(self):
-        self.report.append(astuple(self.report_line))
+        outcome = self.report_line.outcome()
+        self.report_outcomes[outcome] += 1
+        # The summary only shows the rows of the expenses that failed.
+        if self.report_mode == 'full' or outcome == 'failed':
+            with self.metrics.phase('report'):
+                self.report_sink.add(self.report_line)
+
+    def open_report_sink(self):
+        self.report_sink = open_report_sink(
+            self.report_format, list(ReportLine.__annotations__),
+            self.report_path
+        )
 
     def print_report(self):
-        columns = []
-        for field, field_type in ReportLine.__annotations__.items():
-            columns.append(field)
-        print(tabulate(self.report, columns, tablefmt="fancy_grid"))
+        """
+        Finishes the report: the streaming sinks have already written every
+        line, the grid is printed now.
+        """
+        from tabulate import tabulate
+
+        with self.metrics.phase('report'):
+            if self.report_mode == 'summary':
+                print(tabulate(
+                    sorted(self.report_outcomes.items()),
+                    ['outcome', 'expenses'], tablefmt="fancy_grid"
+                ))
+            self.report_sink.close()
 
     def process_sw_expenses(self):
-        for expense in tqdm(self.expenses, desc="Synchronizing expenses..."):
-            if self.is_debt_consolidation(expense):
+        from tqdm import tqdm
+
+        with self.bk.batch(), \
+                tqdm(desc="Synchronizing expenses...") as progress:
+            # Expenses are processed as the pages arrive from Splitwise, a
+            # page at a time so the split of all of them is computed at once.
+            if config['PipelinedSync'].get():
+                def transform(page):
+                    return len(page), self.transform_page(page)
+
+                def write(transformed):
+                    expenses_count, (exp_objs, operations) = transformed
+                    self.write_page(exp_objs, operations)
+                    progress.update(expenses_count)
+
+                Pipeline(
+                    self.sw.iter_expense_pages(), transform, write,
+                    config['PipelineQueueSize'].get()
+                ).run()
+            else:
+                for page in self.sw.iter_expense_pages():
+                    self.process_page(page)
+                    progress.update(len(page))
+            # The rows of all the deleted expenses at once.
+            self.removed_rows = self.bk.delete_pending_expenses()
+
+    def process_page(self, expenses):
+        self.write_page(*self.transform_page(expenses))
+
+    def transform_page(self, expenses):
+        """
+        :return: (Expense objects, their get_batch_operations), without the
+        debt consolidations.
+        """
+        exp_objs = []
+        with self.metrics.phase('transform'):
+            for expense in expenses:
+                if not self.is_debt_consolidation(expense):
+                    exp_objs.append(self.get_expense_obj(expense))
+            operations = self.get_batch_operations(exp_objs)
+        self.sw.forget_cash_comments(expenses)
+        return exp_objs, operations
+
+    def write_page(self, exp_objs, operations):
+        for exp_obj, exp_operations in zip(exp_objs, operations):
+            with self.metrics.phase('transform'):
+                fingerprint = self.get_fingerprint(exp_obj)
+            self.report_line = ReportLine.from_expense(exp_obj)
+
+            if self.is_unchanged(exp_obj, fingerprint):
+                self.report_line.debug = 'unchanged'
+                self.add_report_line()
                 continue
-            exp_obj = self.get_expense_obj(expense)
-            self.report_line = ReportLine()
-            self.report_line.total_amount = exp_obj.total_amount
-            self.report_line.date = exp_obj.date
-            self.report_line.i_paid = exp_obj.i_paid
-            self.report_line.i_owe = exp_obj.i_owe
-            self.report_line.bucket_name = exp_obj.bucket_name
-            self.report_line.name = exp_obj.name
 
+            self.synchronized += 1
             try:
-                self.handle_expense(exp_obj)
+                with self.bk.expense_savepoint(exp_obj.id):
+                    self.handle_expense(exp_obj, exp_operations)
             except Exception as e:
                 if config['debug'].get() is True:
                     traceback.print_exc()
-                self.report_line.debug = e
+                # Only the message, keeping the exception would keep its
+                # traceback (and everything in it) alive until the end.
+                self.report_line.debug = str(e) or type(e).__name__
+                self.errors += 1
+            else:
+                # Without the index it can't be skipped next time anyway (see
+                # has_transactions), and the fingerprint would be saved
+                # without its transactions.
+                if self.fingerprints is not None and self.bk.indexed:
+                    self.fingerprints.stage(
+                        exp_obj.id, fingerprint,
+                        self.bk.get_transaction_ids_by_fi_id(exp_obj.id)
+                    )
             self.add_report_line()
 
+    def get_fingerprint(self, exp_obj):
+        """
+        Everything that decides what an expense looks like in Buckets: the
+        fields derived from Splitwise (bucket included) and the accounts.
+        """
+        data = (
+            FINGERPRINT_VERSION,
+            astuple(exp_obj),
+            sorted(self.bk.account_ids.items()),
+        )
+        return hashlib.sha1(repr(data).encode()).hexdigest()
+
+    def is_unchanged(self, exp_obj, fingerprint):
+        """
+        True when the expense was already synchronized exactly like this and
+        its transactions are still in the budget, so it can be skipped.
+        """
+        if self.fingerprints is None:
+            return False
+        synced_fingerprint, trans_ids = self.fingerprints.get(exp_obj.id)
+        return (
+            synced_fingerprint == fingerprint
+            and self.bk.has_transactions(trans_ids)
+        )
+
     @staticmethod
     def is_debt_consolidation(expense):
         """
@@ -165,14 +393,12 @@ class SplitwiseToBucketsSynch:
         obj['id'] = expense.getId()
         obj['name'] = expense.getDescription()
         obj['is_payment'] = True if expense.getPayment() else False
-        obj['total_amount'] = Decimal(expense.getCost())
-        obj['i_paid'] = Decimal(my_expense_user_obj.getPaidShare())
-        obj['i_owe'] = Decimal(my_expense_user_obj.getOwedShare())
+        obj['total_amount'] = parse_cents(expense.getCost())
+        obj['i_paid'] = parse_cents(my_expense_user_obj.getPaidShare())
+        obj['i_owe'] = parse_cents(my_expense_user_obj.getOwedShare())
         obj['owed_by_others'] = self.sw.get_owed_by_others(expense)
         obj['is_cash'] = self.sw.is_cash(expense)
-        obj['bucket_name'] = config['SplitwiseCategoriesToBucketNames'].get()[
-            expense.getCategory().getId()
-        ]
+        obj['bucket_name'] = self.get_bucket_name(expense.getCategory())
         # TO DO: put all buckets in a dict to make it 1 query
         obj['bucket_id'] = self.bk.get_bucket_id(obj['bucket_name'])
         obj['is_deleted'] = True if expense.getDeletedAt() else False
@@ -181,18 +407,116 @@ class SplitwiseToBucketsSynch:
         # two transactions in Buckets makes it more difficult to verify that
         # everything is up to date.
         # Adding the total paid at the name makes it easier to track.
+        # As Splitwise sends it, like memos have always been.
         if obj['i_paid'] > 0:
-            obj['name'] = f"[{obj['i_paid']}] {obj['name']}"
+            obj['name'] = (
+                f"[{my_expense_user_obj.getPaidShare()}] {obj['name']}"
+            )
 
         return Expense(**obj)
 
-    def handle_expense(self, exp_obj):
+    def get_bucket_name(self, category):
+        """
+        :return: the bucket of the category in
+        SplitwiseCategoriesToBucketNames. If it isn't there, None, like the
+        categories without bucket, and it's remembered to warn about it.
+        """
+        if category.getId() not in self.category_buckets:
+            self.unmapped_categories[category.getId()] = category.getName()
+            return None
+        return self.category_buckets[category.getId()]
+
+    def print_unmapped_categories(self):
+        if not self.unmapped_categories:
+            return
+        categories = ', '.join(
+            f"{category_id} ({name})"
+            for category_id, name in sorted(self.unmapped_categories.items())
+        )
+        print(f"These Splitwise categories aren't in "
+              f"SplitwiseCategoriesToBucketNames, so their expenses were left "
+              f"without bucket: {categories}. 'python cli.py categories' "
+              f"lists all of them.")
+
+    def print_unmapped_catalogue(self):
+        """
+        Warns about the categories of the cached catalogue (see 'python
+        cli.py categories') that aren't in SplitwiseCategoriesToBucketNames,
+        before any of their expenses is synchronized. Without the catalogue in
+        the SessionCache there's nothing to compare, it isn't requested just
+        for this.
+        """
+        categories = self.sw.get_cached_categories()
+        if not categories:
+            return
+        unmapped = [
+            f"{category['id']} ({category['name']})"
+            for parent in categories
+            for category in [parent] + parent['subcategories']
+            if category['id'] not in self.category_buckets
+        ]
+        if unmapped:
+            print(f"These Splitwise categories aren't in "
+                  f"SplitwiseCategoriesToBucketNames, their expenses will be "
+                  f"left without bucket: {', '.join(unmapped)}.")
+
+    def print_removed_rows(self):
+        """
+        How many rows every deleted expense had in the budget file, or only
+        the totals in the summary.
+        """
+        if not self.deleted_expenses:
+            return
+        from tabulate import tabulate
+
+        rows = [
+            (expense_id, name) + self.removed_rows.get(expense_id, (0, 0))
+            for expense_id, name in self.deleted_expenses.items()
+        ]
+        if self.report_mode == 'summary':
+            print(f"Removed {sum(row[2] for row in rows)} transactions and "
+                  f"{sum(row[3] for row in rows)} bucket transactions of "
+                  f"{len(rows)} deleted expenses.")
+            return
+        print(tabulate(
+            rows,
+            ['deleted expense', 'name', 'transactions', 'bucket transactions'],
+            tablefmt="fancy_grid"
+        ))
+
+    def print_lock_waits(self):
+        """
+        Only if the budget file was locked by someone else (like the Buckets
+        app) at some point.
+        """
+        if self.metrics.lock_waits:
+            print(f"Waited {self.metrics.lock_wait_seconds:.1f} seconds "
+                  f"for the budget file, locked by someone else "
+                  f"(lock waits: {self.metrics.lock_waits}). Closing Buckets "
+                  f"while synchronizing avoids it.")
+
+    def handle_expense(self, exp_obj, operations=None):
+        """
+        :param operations: the ones of get_batch_operations, or None to work
+        them out with get_expense_operations.
+        """
         if exp_obj.is_deleted:
             self.bk.delete_expense(exp_obj)
+            self.deleted_expenses[exp_obj.id] = exp_obj.name
             self.report_line.debug = 'deleted'
             return
 
+        if operations is None:
+            operations = self.get_expense_operations(exp_obj)
+        for method, details in operations:
+            getattr(self.bk, method)(**details)
+
+    @staticmethod
+    def get_expense_operations(exp_obj):
         """
+        :return: list of (BucketManager method, kwargs) tuples with the
+        transfers and expenses that exp_obj needs in Buckets.
+
         The "4 transactions approach" explained:
 
         Combining every possible situation in Splitwise, for each SW expense
@@ -225,135 +549,323 @@ class SplitwiseToBucketsSynch:
 
         But more practically, just delete the 0€ Buckets' transactions after
         you verify that the expense details are finally correct in Splitwise.
+
+        The amounts are computed by splits.compute_splits, which explains
+        each case, like for the batches in get_batch_operations.
+        """
+        (payment, ), (splitwise, ), (transfer, ) = compute_splits(
+            SplitColumns([exp_obj])
+        )
+        return SplitwiseToBucketsSynch.build_operations(
+            exp_obj, payment, splitwise, transfer
+        )
+
+    @classmethod
+    def get_batch_operations(cls, exp_objs):
         """
-        payment_expense_details = {
-            'date': exp_obj.date,
-            'amount': 0.00,
-            'memo': exp_obj.name,
-            'fi_id': exp_obj.id,
-            'general_cat': None,
-            'bucket_id': exp_obj.bucket_id,
-            'account': 'cash' if exp_obj.is_cash else 'payment'
-        }
-
-        splitwise_expense_details = {
-            'date': exp_obj.date,
-            'amount': 0.00,
-            'memo': exp_obj.name,
-            'fi_id': exp_obj.id,
-            'general_cat': None,
-            'bucket_id': exp_obj.bucket_id,
-            'account': 'splitwise'
-        }
-
-        transfer_to_splitwise = {
-            'date': exp_obj.date,
-            'amount': 0.00,
-            'memo': exp_obj.name,
-            'fi_id': exp_obj.id,
-            'from_account': 'cash' if exp_obj.is_cash else 'payment',
-            'to_account': 'splitwise'
-        }
+        Same as get_expense_operations for each of exp_objs, but with the
+        amounts of all of them computed at once by splits.compute_splits.
 
+        :return: list with the list of operations of each expense.
+        """
+        return [
+            cls.build_operations(exp_obj, payment, splitwise, transfer)
+            for exp_obj, payment, splitwise, transfer in zip(
+                exp_objs, *compute_splits(SplitColumns(exp_objs))
+            )
+        ]
+
+    @staticmethod
+    def build_operations(exp_obj, payment, splitwise, transfer):
+        """
+        Payments (you got paid some money, so a transfer is made from your
+        splitwise account into the account you got it) get only that
+        transfer. That's because if two create_or_update_transfers are
+        executed, we cannot apply the system of sending 0€ transactions even
+        if we don't need them: for transfers the 0€ ones are processed and
+        updated, so the last one would override the prior.
+
+        :param payment, splitwise, transfer: the amounts of the expense, as
+        splits.compute_splits returns them.
+        :return: list of (BucketManager method, kwargs) tuples.
+        """
+        account = 'cash' if exp_obj.is_cash else 'payment'
         if exp_obj.is_payment:
-            """
-            In the incoming transfers you got paid some money, so your
-            Splitwise balance is decreased (in Splitwise app) and therefore
-            in Buckets a transfer is made from your splitwise account into
-            the account you got the payment.
-            
-            That case is treated separately to make sure that only this
-            transaction is executed in that case.
-            
-            That's because if two create_or_update_transfers are executed,
-            we cannot apply the system of sending 0€ transactions even if we
-            don't need them, because for transfers the 0€ ones are processed
-            and updated.
-            Therefore: in multiple create_or_update_transfers, the last one
-            will override the prior.
-            """
-            transfer_from_splitwise = {
+            # If you're getting money in cash, put in the right account.
+            return [('create_or_update_transfer', {
                 'date': exp_obj.date,
-                'amount': exp_obj.total_amount,
+                'amount': transfer,
                 'memo': exp_obj.name,
                 'fi_id': exp_obj.id,
                 'from_account': 'splitwise',
-                # If you're getting money in cash, put in the right account:
-                'to_account': 'cash' if exp_obj.is_cash else 'payment'
-            }
-            self.bk.create_or_update_transfer(**transfer_from_splitwise)
-        else:
-            if exp_obj.i_paid < exp_obj.i_owe:
-                """
-                Say..
-                I paid: 1€              I owe: 25€
-                Paid by other: 49€      Owed by other: 25€
-                
-                Means 1 expense is the 1€ from payments account,
-                and another expense is 24€ from splitwise account.
-
-                But if...
-                I paid: 0€              I owe: 25€
-                Paid by other: 50€      Owed by other: 25€
-                
-                There's only one expense of 24€ from splitwise account.
-                Nonetheless we don't know if that's an expense already
-                existing in Buckets (previously marked as I paid something) and
-                now it's modified. To handle that situation we need the 0€
-                expense to be passed to BucketManager, so it will detect that
-                it's an update and set the existing payments account expense
-                to 0€.
-                Not super elegant to end up with a 0€ transaction in Buckets,
-                but it's the most informative and less problematic option I
-                came up with.
-                """
-                payment_amount = exp_obj.i_paid * -1
-                payment_expense_details['amount'] = payment_amount
-                splitwise_amount = exp_obj.i_owe - exp_obj.i_paid
-                splitwise_expense_details['amount'] = splitwise_amount * -1
-
-            if exp_obj.i_paid == exp_obj.i_owe:
-                """
-                Say..
-                I paid: 25€             I owe: 25€
-                Paid by other: 25€      Owed by other: 25€
-    
-                Means only 1 expense of 25€ from payments account.
-                
-                """
-                payment_expense_details['amount'] = exp_obj.i_paid * -1
-            if exp_obj.i_paid > exp_obj.i_owe:
-                """
-                Say..
-                I paid: 49€             I owe: 25€
-                Paid by other: 1€       Owed by other: 25€
-
-                Means:
-                - One 25€ expense from payments account,
-                - A transfer from payments account to splitwise account
-                  for 24€.
-
-                Say..
-                I paid: 13€             I owe: 0€
-                Paid by other: 0€       Owed by other: 13€
-
-                Means:
-                - A transfer from payments acc to splitwise acc. for 13€
-                So we can leave the payment_expense_details bc it's going to
-                be 0€ and not do anything anyway.
-                """
-                payment_amount = exp_obj.i_owe * -1
-                payment_expense_details['amount'] = payment_amount
-                transfer_amount = exp_obj.i_paid - exp_obj.i_owe
-                transfer_to_splitwise['amount'] = transfer_amount
-
-            self.bk.create_or_update_transfer(**transfer_to_splitwise)
-            self.bk.create_or_update_expense(**payment_expense_details)
-            self.bk.create_or_update_expense(**splitwise_expense_details)
+                'to_account': account
+            })]
+        return [
+            ('create_or_update_transfer', {
+                'date': exp_obj.date,
+                'amount': transfer,
+                'memo': exp_obj.name,
+                'fi_id': exp_obj.id,
+                'from_account': account,
+                'to_account': 'splitwise'
+            }),
+            ('create_or_update_expense', {
+                'date': exp_obj.date,
+                'amount': payment,
+                'memo': exp_obj.name,
+                'fi_id': exp_obj.id,
+                'general_cat': None,
+                'bucket_id': exp_obj.bucket_id,
+                'account': account
+            }),
+            ('create_or_update_expense', {
+                'date': exp_obj.date,
+                'amount': splitwise,
+                'memo': exp_obj.name,
+                'fi_id': exp_obj.id,
+                'general_cat': None,
+                'bucket_id': exp_obj.bucket_id,
+                'account': 'splitwise'
+            }),
+        ]
 
-    def run(self):
-        self.process_sw_expenses()
-        self.print_report()
+    def print_plan(self, plan):
+        from tabulate import tabulate
 
+        with self.metrics.phase('report'):
+            print(tabulate(
+                plan.counts(), ['table', 'operation', 'rows'],
+                tablefmt="fancy_grid"
+            ))
 
-SplitwiseToBucketsSynch().run()
+    def export_metrics(self, json_path=None, prometheus_path=None):
+        """
+        Writes the Metrics of the run, with its number of expenses and
+        errors, to the given files.
+        """
+        self.metrics.totals.update({
+            'expenses': self.sw.expenses_count,
+            'errors': self.errors,
+        })
+        if json_path:
+            self.metrics.write_json(json_path)
+        if prometheus_path:
+            self.metrics.write_prometheus(prometheus_path)
+
+    def run(self):
+        # Offline nothing is requested, so the Splitwise client isn't even
+        # imported and there's nothing to catch.
+        unauthorized = ()
+        if not self.sw.offline:
+            from splitwise.exception import SplitwiseUnauthorizedException
+            unauthorized = SplitwiseUnauthorizedException
+        try:
+            with self.bk.tuned():
+                self.synchronize()
+        except unauthorized:
+            # With the SessionCache, authenticating doesn't request anything,
+            # so a token that stopped working is noticed here instead.
+            print(f"😿 {INVALID_TOKEN}")
+            sys.exit()
+        finally:
+            if self.fingerprints is not None:
+                # Only what wasn't flushed is left, because the run failed, its
+                # rows were rolled back or it was only a --plan. It mustn't be
+                # saved by the next run (--watch).
+                self.fingerprints.discard_staged()
+        self.print_lock_waits()
+
+    def synchronize(self):
+        if self.plan_only or config['Buckets']['TwoPhaseSync'].get():
+            self.bk.start_plan()
+        self.open_report_sink()
+        try:
+            self.process_sw_expenses()
+        except BaseException:
+            self.report_sink.close()
+            raise
+        if self.sw.expenses_count == 0:
+            if self.sw.full_sync:
+                self.report_sink.close()
+                print("Couldn't retrieve the expenses 😿")
+                return
+            print("Nothing changed in Splitwise since the last run 😻")
+        elif self.sw.full_sync:
+            print(f"{self.sw.expenses_count} imported expenses from "
+                  f"Splitwise")
+        else:
+            print(f"{self.sw.expenses_count} expenses updated in Splitwise "
+                  f"since the last run")
+        if self.bk.plan is not None:
+            plan = self.bk.plan
+            self.print_report()
+            self.print_plan(plan)
+            self.print_unmapped_categories()
+            if self.plan_only:
+                print("Nothing has been written to your budget (--plan).")
+                return
+            if not plan.is_empty():
+                self.bk.apply_plan()
+                self.removed_rows = plan.removed_rows
+                if self.fingerprints is not None:
+                    self.fingerprints.map_staged_ids(plan.get_applied_id)
+            self.print_removed_rows()
+        else:
+            self.print_report()
+            self.print_unmapped_categories()
+            self.print_removed_rows()
+        if self.fingerprints is not None:
+            # Only now everything is committed in the budget file.
+            self.fingerprints.flush()
+        if not self.sw.offline:
+            # Expenses that failed will be requested again in the next run.
+            self.sw.save_sync_state(advance=self.errors == 0)
+
+
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Synchronize your Splitwise expenses into your Buckets' "
+                    "budget."
+    )
+    parser.add_argument(
+        '--plan', action='store_true',
+        help="Only show how many rows would be inserted, updated and deleted "
+             "in the budget file, without writing anything."
+    )
+    parser.add_argument(
+        '--no-comment-cache', action='store_true',
+        help="Retrieve the comments of all the expenses from Splitwise, "
+             "without using or updating the comment cache."
+    )
+    parser.add_argument(
+        '--clear-comment-cache', action='store_true',
+        help="Empty the comment cache before synchronizing."
+    )
+    parser.add_argument(
+        '--offline', action='store_true',
+        help="Synchronize the expenses saved the last time with "
+             "MirrorExpenses, without connecting to Splitwise."
+    )
+    parser.add_argument(
+        '--summary', action='store_true',
+        help="Instead of a row per expense, only show how many expenses "
+             "were synchronized, unchanged, deleted or failed (and the ones "
+             "that failed). Same as setting Report to 'summary'."
+    )
+    parser.add_argument(
+        '--report-format', choices=sorted(REPORT_SINKS),
+        help="'grid' prints the report as a table at the end, 'jsonl' and "
+             "'csv' write every line as soon as its expense is done. Same as "
+             "the ReportFormat setting."
+    )
+    parser.add_argument(
+        '--report-path', metavar='PATH',
+        help="File where the jsonl and csv reports are written (appending "
+             "to it), instead of the standard output. Same as the ReportPath "
+             "setting."
+    )
+    parser.add_argument(
+        '--fake-splitwise', metavar='FIXTURES',
+        help="Talk to a local stand-in of Splitwise that answers with the "
+             "expenses, comments and categories of the given JSON file, "
+             "see benchmarks/fake_splitwise.py."
+    )
+    parser.add_argument(
+        '--record-splitwise', metavar='FIXTURES',
+        help="Save what Splitwise answers to the given JSON file, to use it "
+             "later with --fake-splitwise."
+    )
+    parser.add_argument(
+        '--watch', action='store_true',
+        help="Keep running and synchronize again every now and then, more "
+             "often after recent changes (see the Watch settings). Stop it "
+             "with Ctrl+C or SIGTERM."
+    )
+    parser.add_argument(
+        '--metrics-json', metavar='PATH',
+        help="Write the time, Splitwise requests, SQL statements and rows of "
+             "each phase of the synchronization to a JSON file."
+    )
+    parser.add_argument(
+        '--metrics-prom', metavar='PATH',
+        help="Write the same metrics as --metrics-json in Prometheus' text "
+             "format, e.g. for node_exporter's textfile collector."
+    )
+    parser.add_argument(
+        '--profiles', action='store_true',
+        help="Synchronize all the profiles in the Profiles setting, in "
+             "parallel."
+    )
+    parser.add_argument(
+        '--profile', action='append', default=[], metavar='NAME',
+        help="Synchronize only this profile of the Profiles setting. Can be "
+             "used more than once."
+    )
+    args = parser.parse_args(argv)
+    if args.watch and (args.plan or args.offline):
+        parser.error("--watch can't be used with --plan or --offline.")
+    if args.profile:
+        args.profiles = True
+    if args.profiles and (args.watch or args.fake_splitwise
+                          or args.record_splitwise):
+        parser.error("--profiles can't be used with --watch, "
+                     "--fake-splitwise or --record-splitwise.")
+    return args
+
+
+def main(argv=None, prog=None):
+    """
+    Runs what the command line asks for, see parse_args.
+    """
+    args = parse_args(argv, prog)
+    if args.profiles:
+        from profiles import get_profiles, sync_profiles
+        results = sync_profiles(
+            get_profiles(args.profile),
+            {
+                'plan_only': args.plan,
+                'comment_cache': not args.no_comment_cache,
+                'clear_comment_cache': args.clear_comment_cache,
+                'offline': args.offline,
+                'report_mode': 'summary' if args.summary else None,
+                'report_format': args.report_format,
+                'report_path': args.report_path,
+            },
+            args.metrics_json, args.metrics_prom
+        )
+        sys.exit(1 if any(result['failure'] for result in results) else 0)
+    splitwise = None
+    if args.fake_splitwise:
+        from benchmarks.fake_splitwise import FakeSplitwise
+        splitwise = FakeSplitwise.from_file(args.fake_splitwise)
+    elif args.record_splitwise:
+        from splitwise import Splitwise
+        from benchmarks.fake_splitwise import RecordingSplitwise
+        splitwise = RecordingSplitwise(Splitwise(
+            config['Splitwise']['ConsumerKey'].get(),
+            config['Splitwise']['ConsumerSecret'].get()
+        ))
+    synch = SplitwiseToBucketsSynch(
+        plan_only=args.plan,
+        comment_cache=not args.no_comment_cache,
+        clear_comment_cache=args.clear_comment_cache,
+        offline=args.offline,
+        splitwise=splitwise,
+        report_mode='summary' if args.summary else None,
+        report_format=args.report_format,
+        report_path=args.report_path,
+    )
+    if args.watch:
+        from watch import SyncWatcher
+        SyncWatcher(synch, args.metrics_json, args.metrics_prom).run()
+    else:
+        synch.run()
+        synch.export_metrics(args.metrics_json, args.metrics_prom)
+    synch.bk.report_sql_profile()
+    if args.record_splitwise:
+        splitwise.save(args.record_splitwise)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+How many SQL statements handle_expense runs for each kind of expense, so a
+change that makes it query the budget file once per row (or more) fails here
+instead of only making big synchronizations slower.
+"""
+from datetime import datetime, timezone
+
+import pytest
+
+from benchmarks.generate_budget import create_budget
+from benchmarks.generate_expenses import CURRENT_USER_ID, generate_expenses
+from benchmarks.run import configure
+
+# (i_paid, i_owe, is_payment) of a 20.00 expense, and the most statements
+# that creating or updating it can take without and with
+# PrefetchTransactions.
+BRANCHES = {
+    'payment': ((2000, 0, True), 5, 4),
+    'paid less than owed': ((100, 1000, False), 13, 8),
+    'paid nothing': ((0, 1000, False), 8, 4),
+    'paid what owed': ((1000, 1000, False), 8, 4),
+    'paid more than owed': ((2000, 1000, False), 12, 8),
+    'owes nothing': ((2000, 0, False), 7, 4),
+}
+
+
+@pytest.fixture(params=[False, True], ids=['queried', 'prefetched'])
+def synch(request, tmp_path):
+    import local_store
+    from sql_profiler import SqlProfiler
+    from synch import SplitwiseToBucketsSynch
+
+    budget_path = str(tmp_path / 'budget.buckets')
+    create_budget(budget_path, 200, synced_expenses=50)
+    configure(str(tmp_path), budget_path, [
+        ('Buckets.PrefetchTransactions', request.param),
+    ])
+    # Offline, so nothing is requested to Splitwise, it only needs to know
+    # whose expenses they are.
+    local_store.ExpenseMirror(
+        local_store.connect(), CURRENT_USER_ID
+    ).save_many(list(generate_expenses(1)))
+    synch = SplitwiseToBucketsSynch(offline=True)
+    synch.bk.profiler = SqlProfiler()
+    yield synch
+    synch.close()
+
+
+def make_expense(name, i_paid, i_owe, is_payment):
+    from synch import Expense
+
+    return Expense(
+        id=1000, name=name,
+        date=datetime(2021, 1, 1, tzinfo=timezone.utc), total_amount=2000,
+        i_paid=i_paid, i_owe=i_owe, bucket_name='Food', bucket_id=1,
+        owed_by_others=2000 - i_owe, is_cash=False, is_payment=is_payment,
+        is_deleted=False
+    )
+
+
+@pytest.mark.parametrize('branch', list(BRANCHES))
+def test_handle_expense_query_budget(synch, branch):
+    amounts, queried, prefetched = BRANCHES[branch]
+    budget = prefetched if synch.bk.indexed else queried
+    # Created the first time, updated the second one.
+    for name in ('created', 'updated'):
+        with synch.bk.profiler.budget(budget, f"{branch} ({name})"):
+            synch.handle_expense(make_expense(name, *amounts))
@@ -0,0 +1,123 @@
+"""
+splits.compute_splits against the per-expense branching it replaced, for the
+cases explained in splits.py and lots of random expenses, and the operations
+of both get_expense_operations and get_batch_operations built from it.
+"""
+import random
+from datetime import datetime, timezone
+
+import pytest
+
+SEED = 0
+EXPENSES = 5000
+
+
+def make_expense(expense_id, total_amount, i_paid, i_owe, is_payment=False,
+                 is_cash=False):
+    from synch import Expense
+
+    return Expense(
+        id=expense_id, name=f"expense {expense_id}",
+        date=datetime(2021, 1, 1, tzinfo=timezone.utc),
+        total_amount=total_amount, i_paid=i_paid, i_owe=i_owe,
+        owed_by_others=total_amount - i_owe, bucket_name='Food', bucket_id=1,
+        is_cash=is_cash, is_payment=is_payment, is_deleted=False
+    )
+
+
+def random_expense(rng, expense_id):
+    total = rng.choice([0, 1, 2, 99, 100, rng.randint(0, 10 ** 7)])
+    shares = [0, total, total // 2, total - total // 2,
+              rng.randint(0, total)]
+    return make_expense(
+        expense_id, total, rng.choice(shares), rng.choice(shares),
+        is_payment=rng.random() < 0.1, is_cash=rng.random() < 0.2
+    )
+
+
+def expected_splits(exp_obj):
+    """
+    (payment, splitwise, transfer) of one expense, branching like
+    get_expense_operations did before splits.py.
+    """
+    if exp_obj.is_payment:
+        return 0, 0, exp_obj.total_amount
+    payment = splitwise = transfer = 0
+    if exp_obj.i_paid < exp_obj.i_owe:
+        payment = exp_obj.i_paid * -1
+        splitwise = (exp_obj.i_owe - exp_obj.i_paid) * -1
+    if exp_obj.i_paid == exp_obj.i_owe:
+        payment = exp_obj.i_paid * -1
+    if exp_obj.i_paid > exp_obj.i_owe:
+        payment = exp_obj.i_owe * -1
+        transfer = exp_obj.i_paid - exp_obj.i_owe
+    return payment, splitwise, transfer
+
+
+def adds_up(exp_obj, operations):
+    amounts = [details['amount'] for method, details in operations]
+    if exp_obj.is_payment:
+        return amounts == [exp_obj.total_amount]
+    transfer, payment, splitwise = amounts
+    return (
+        -(payment + splitwise) == exp_obj.i_owe
+        and transfer - payment == exp_obj.i_paid
+    )
+
+
+# The cases of splits.py, for a 50€ expense, plus the zero ones.
+CASES = {
+    'paid less than owed': (
+        make_expense(1, 5000, 100, 2500), (-100, -2400, 0)
+    ),
+    'paid nothing': (make_expense(2, 5000, 0, 2500), (0, -2500, 0)),
+    'paid what owed': (make_expense(3, 5000, 2500, 2500), (-2500, 0, 0)),
+    'paid more than owed': (
+        make_expense(4, 5000, 4900, 2500), (-2500, 0, 2400)
+    ),
+    'owes nothing': (make_expense(5, 1300, 1300, 0), (0, 0, 1300)),
+    'zero': (make_expense(6, 0, 0, 0), (0, 0, 0)),
+    'payment': (make_expense(7, 5000, 0, 5000, is_payment=True),
+                (0, 0, 5000)),
+    'zero payment': (make_expense(8, 0, 0, 0, is_payment=True), (0, 0, 0)),
+}
+
+
+@pytest.fixture(scope='module')
+def expenses():
+    rng = random.Random(SEED)
+    return (
+        [exp_obj for exp_obj, splits in CASES.values()]
+        + [random_expense(rng, i) for i in range(100, 100 + EXPENSES)]
+    )
+
+
+@pytest.mark.parametrize('exp_obj, splits', CASES.values(), ids=CASES.keys())
+def test_cases(exp_obj, splits):
+    from splits import SplitColumns, compute_splits
+
+    (payment, ), (splitwise, ), (transfer, ) = compute_splits(
+        SplitColumns([exp_obj])
+    )
+    assert (payment, splitwise, transfer) == splits
+    assert expected_splits(exp_obj) == splits
+
+
+def test_compute_splits(expenses):
+    from splits import SplitColumns, compute_splits
+
+    assert list(zip(*compute_splits(SplitColumns(expenses)))) == [
+        expected_splits(exp_obj) for exp_obj in expenses
+    ]
+
+
+def test_operations(expenses):
+    from synch import SplitwiseToBucketsSynch
+
+    batch = SplitwiseToBucketsSynch.get_batch_operations(expenses)
+    assert len(batch) == len(expenses)
+    for exp_obj, operations in zip(expenses, batch):
+        assert SplitwiseToBucketsSynch.get_expense_operations(
+            exp_obj
+        ) == operations
+        assert adds_up(exp_obj, operations), exp_obj
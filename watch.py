@@ -0,0 +1,83 @@
+import signal
+import threading
+import traceback
+
+from settings import config
+
+# Views, only read when they're needed so the module can be imported without
+# a config.yaml.
+debug = config['debug']
+config = config['Watch']
+
+
+class SyncWatcher:
+    """
+    Runs the synchronization again and again in the same process ('python
+    synch.py --watch'), so the budget file connection, the transactions index,
+    the Splitwise session and the local caches stay warm between runs.
+
+    After a run that synchronized something it waits MinIntervalSeconds, and
+    every run without changes multiplies the wait by IdleFactor, up to
+    MaxIntervalSeconds.
+
+    SIGINT (Ctrl+C) or SIGTERM stop it once the current run, if any, has
+    finished. A second one stops it right away.
+    """
+    def __init__(self, synch, metrics_json=None, metrics_prom=None):
+        self.synch = synch
+        self.metrics_json = metrics_json
+        self.metrics_prom = metrics_prom
+        self.stopping = threading.Event()
+        self.interval = config['MinIntervalSeconds'].get()
+
+    def stop(self, signum, frame):
+        print("Stopping after the current synchronization...")
+        self.stopping.set()
+        # The next signal gets the default behaviour.
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def get_next_interval(self, changed):
+        if changed:
+            return config['MinIntervalSeconds'].get()
+        return min(
+            self.interval * config['IdleFactor'].get(),
+            config['MaxIntervalSeconds'].get()
+        )
+
+    def run_once(self):
+        """
+        :return: whether anything was synchronized.
+        """
+        if self.synch.bk.refresh():
+            print("The budget file was changed outside the synchronization, "
+                  "reloaded it.")
+        try:
+            self.synch.run()
+            self.synch.export_metrics(self.metrics_json, self.metrics_prom)
+            return self.synch.synchronized > 0
+        finally:
+            self.synch.reset()
+
+    def run(self):
+        previous_handlers = (
+            signal.signal(signal.SIGINT, self.stop),
+            signal.signal(signal.SIGTERM, self.stop),
+        )
+        try:
+            while not self.stopping.is_set():
+                try:
+                    changed = self.run_once()
+                except Exception as e:
+                    if debug.get() is True:
+                        traceback.print_exc()
+                    print(f"😿 The synchronization failed with the error: {e}")
+                    changed = False
+                self.interval = self.get_next_interval(changed)
+                if not self.stopping.is_set():
+                    print(f"Next synchronization in {self.interval} seconds.")
+                self.stopping.wait(self.interval)
+        finally:
+            signal.signal(signal.SIGINT, previous_handlers[0])
+            signal.signal(signal.SIGTERM, previous_handlers[1])
+            self.synch.close()